@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import BATCH_LOOKAHEAD
+except ImportError:
+    BATCH_LOOKAHEAD = 3  # Items fetched and downloaded ahead of the ones uploading
+
+try:
+    from config import BATCH_WORKERS
+except ImportError:
+    BATCH_WORKERS = 3  # Items of one batch uploading at the same time
+
+try:
+    from config import BATCH_WORKERS_BY_TIER
+except ImportError:
+    BATCH_WORKERS_BY_TIER = {}  # e.g. {"premium": 6}, users without a tier get BATCH_WORKERS
+
+def workers_for_tier(tier: Optional[str]) -> int:
+    """Concurrent uploads allowed for one batch of a user in `tier`"""
+    return BATCH_WORKERS_BY_TIER.get(tier, BATCH_WORKERS) if tier else BATCH_WORKERS
+
+async def run_batch(
+    item_ids: Iterable[int],
+    prefetch: Callable[[int], Awaitable[Any]],
+    upload: Callable[[int, Any], Awaitable[Any]],
+    deliver: Callable[[int, Any], Awaitable[None]],
+    discard: Callable[[Any], Awaitable[None]],
+    is_cancelled: Callable[[], bool],
+    workers: int = BATCH_WORKERS,
+    lookahead: int = BATCH_LOOKAHEAD
+) -> Tuple[int, int, bool]:
+    """Process a batch with `workers` concurrent uploads and in-order delivery.
+
+    Items are prefetched, then uploaded once one of `workers` slots frees up while up to
+    `lookahead` further items download. Finished items wait in a reorder buffer so that
+    deliver() always sees them in id order. Returns (success, failed, cancelled).
+    """
+    item_ids = iter(item_ids)
+    workers = max(1, workers)
+    window = workers + max(0, lookahead)
+    slots = asyncio.Semaphore(workers)
+    pending = deque()  # Started items in id order, doubles as the reorder buffer
+    success = failed = 0
+    cancelled = False
+
+    async def run_item(item_id: int):
+        item = await prefetch(item_id)
+        try:
+            async with slots:
+                return await upload(item_id, item)
+        except asyncio.CancelledError:
+            if item is not None:
+                await discard(item)
+            raise
+
+    def fill():
+        while len(pending) < window:
+            try:
+                item_id = next(item_ids)
+            except StopIteration:
+                return
+            pending.append((item_id, asyncio.create_task(run_item(item_id))))
+
+    try:
+        fill()
+        while pending:
+            if is_cancelled():
+                cancelled = True
+                break
+
+            item_id, task = pending.popleft()
+            # Keep the window full while we wait for the oldest item
+            fill()
+            try:
+                item = await task
+                await deliver(item_id, item)
+                success += 1
+            except Exception as e:
+                logger.error(f"Error processing message {item_id}: {e}")
+                failed += 1
+    finally:
+        # Drop whatever was started but never delivered
+        for _, task in pending:
+            task.cancel()
+        for item_id, task in pending:
+            try:
+                item = await task
+            except (asyncio.CancelledError, Exception):
+                continue
+            if item is not None:
+                try:
+                    await discard(item)
+                except Exception as e:
+                    logger.error(f"Error discarding message {item_id}: {e}")
+
+    return success, failed, cancelled
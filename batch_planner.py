@@ -0,0 +1,104 @@
+import logging
+from collections import Counter
+from typing import Dict, List, Optional
+
+from pyrogram import Client
+from pyrogram.types import Message
+
+from utils import get_message_type
+
+logger = logging.getLogger(__name__)
+
+PLAN_CHUNK = 200  # Most ids one get_messages call accepts
+MAX_ALBUM = 10  # Most files one media group holds
+ALBUM_TYPES = ("Photo", "Video", "Document", "Audio")
+MAX_ALBUM_FILE = 2 * 1024 * 1024 * 1024  # Bigger videos are split, which an album can't hold
+
+class BatchPlan:
+    """What a batch will transfer, built from message metadata before any transfer starts"""
+    def __init__(self):
+        self.item_ids: List[int] = []  # Messages worth processing, in order
+        self.messages: Dict[int, Message] = {}
+        self.skipped: List[int] = []  # Deleted, empty or service messages
+        self.total_bytes = 0
+        self.type_counts: Counter = Counter()
+
+    def add(self, msg: Message):
+        msg_type = get_message_type(msg)
+        media = getattr(msg, msg_type.lower(), None)
+        self.item_ids.append(msg.id)
+        self.messages[msg.id] = msg
+        self.type_counts[msg_type] += 1
+        self.total_bytes += getattr(media, "file_size", 0) or 0
+
+    def units(self) -> list:
+        """Item ids in order, consecutive members of one album joined into a tuple"""
+        units, album, album_id = [], [], None
+
+        def flush():
+            if len(album) > 1:
+                units.append(tuple(album))
+            else:
+                units.extend(album)
+            album.clear()
+
+        for item_id in self.item_ids:
+            group_id = self._album_id(self.messages.get(item_id))
+            if group_id and group_id == album_id and len(album) < MAX_ALBUM:
+                album.append(item_id)
+                continue
+            flush()
+            album_id = group_id
+            if group_id:
+                album.append(item_id)
+            else:
+                units.append(item_id)
+        flush()
+        return units
+
+    @staticmethod
+    def _album_id(msg: Optional[Message]) -> Optional[str]:
+        """Media group of a message that can be resent as part of an album"""
+        if not msg or not msg.media_group_id:
+            return None
+        msg_type = get_message_type(msg)
+        media = getattr(msg, msg_type.lower(), None)
+        if msg_type not in ALBUM_TYPES or (getattr(media, "file_size", 0) or 0) > MAX_ALBUM_FILE:
+            return None
+        return msg.media_group_id
+
+    def pop_message(self, item_id: int) -> Optional[Message]:
+        """Hand out the fetched message of an item, once"""
+        return self.messages.pop(item_id, None)
+
+    def describe(self) -> str:
+        """Summary for the progress message"""
+        lines = [f"`{len(self.item_ids)}` items, {format_size(self.total_bytes)}"]
+        if self.type_counts:
+            lines.append(" · ".join(f"{t} {n}" for t, n in self.type_counts.most_common()))
+        if self.skipped:
+            lines.append(f"Skipping {len(self.skipped)} deleted or service messages")
+        return "\n".join(lines)
+
+async def plan_batch(client: Client, chat_id, item_ids: List[int]) -> BatchPlan:
+    """Fetch the messages of a batch in chunks and plan around the ones that can't be delivered"""
+    plan = BatchPlan()
+    for start in range(0, len(item_ids), PLAN_CHUNK):
+        chunk = item_ids[start:start + PLAN_CHUNK]
+        msgs = await client.get_messages(chat_id, chunk)
+        found = {msg.id: msg for msg in msgs if msg and not msg.empty}
+        for item_id in chunk:
+            msg = found.get(item_id)
+            if msg is None or msg.service:
+                plan.skipped.append(item_id)
+            else:
+                plan.add(msg)
+    logger.info(f"Planned batch of {len(item_ids)} messages in {chat_id}: {len(plan.item_ids)} items, "
+                f"{plan.total_bytes} bytes, {len(plan.skipped)} skipped")
+    return plan
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
@@ -0,0 +1,58 @@
+"""Per-file cost of filename rules as a user's rule count grows.
+
+Compares the old loop of one re.sub per rule with the compiled matcher of filename_rules.
+Run with `python bench_sanitize.py > bench_output.txt`.
+"""
+import random
+import re
+import string
+import timeit
+
+from filename_rules import RuleCache, compile_rules, sanitize
+
+RULE_COUNTS = (1, 10, 50, 200)
+FILES = 200
+REPEAT = 5
+
+def sanitize_per_rule(name: str, user_replacements: dict = None) -> str:
+    """sanitize_filename before rules were compiled"""
+    if user_replacements:
+        for pattern, replacement in user_replacements.items():
+            if pattern.startswith('@') or not replacement:
+                name = re.sub(rf'\b{pattern[1:] if pattern.startswith("@") else pattern}\b', '', name, flags=re.IGNORECASE)
+            else:
+                name = re.sub(rf'\b{pattern}\b', replacement, name, flags=re.IGNORECASE)
+    name = re.sub(r'[<>:"/\\|?*]', '', name)
+    return name.strip()
+
+def make_rules(count: int, rng: random.Random) -> dict:
+    words = {''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))) for _ in range(count * 2)}
+    return {word: ('' if i % 3 == 0 else word.upper()) for i, word in zip(range(count), sorted(words))}
+
+def make_names(rules: dict, rng: random.Random) -> list:
+    words = list(rules) + ['lecture', 'part', 'final', 'HD', '1080p']
+    return [
+        ' '.join(rng.choices(words, k=rng.randint(3, 8))) + rng.choice(['.mp4', '.pdf', '.mkv'])
+        for _ in range(FILES)
+    ]
+
+def per_file_us(run, names: list) -> float:
+    seconds = min(timeit.repeat(lambda: [run(name) for name in names], number=1, repeat=REPEAT))
+    return seconds / len(names) * 1e6
+
+def main():
+    rng = random.Random(0)
+    print(f"{'rules':>6} {'per rule':>12} {'compiled':>12} {'speedup':>8}")
+    for count in RULE_COUNTS:
+        rules = make_rules(count, rng)
+        names = make_names(rules, rng)
+        cache = RuleCache()
+        # Plain word rules don't chain, so both give the same names
+        assert all(sanitize(name, compile_rules(rules)) == sanitize_per_rule(name, rules) for name in names)
+
+        old = per_file_us(lambda name: sanitize_per_rule(name, rules), names)
+        new = per_file_us(lambda name: sanitize(name, cache.get(1, rules)), names)
+        print(f"{count:>6} {old:>10.1f}us {new:>10.1f}us {old / new:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
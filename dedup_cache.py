@@ -0,0 +1,106 @@
+import hashlib
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import DEDUP_MAX_ENTRIES
+except ImportError:
+    DEDUP_MAX_ENTRIES = 100000
+
+try:
+    from config import DEDUP_TTL_DAYS
+except ImportError:
+    DEDUP_TTL_DAYS = 30  # Entries unused for this long expire
+
+PRUNE_EVERY = 100  # Check the size cap after this many inserts
+
+def make_key(file_unique_id: str, *output_settings) -> str:
+    """Build a cache key from the source media and everything that changes the output"""
+    payload = json.dumps([file_unique_id, *output_settings], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class DedupCache:
+    """Persistent map from source media to the dump channel message holding it"""
+
+    def __init__(self, db, max_entries: int = DEDUP_MAX_ENTRIES, ttl_days: int = DEDUP_TTL_DAYS):
+        self.collection = db.dedup_cache
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._inserts = 0
+
+    async def setup(self):
+        """Create indexes used for expiry and invalidation"""
+        await self.collection.create_index('last_used_at', expireAfterSeconds=self.ttl_seconds)
+        await self.collection.create_index('dump_msg_id')
+
+    async def get(self, key: str) -> Optional[int]:
+        """Return the cached dump message id for a key, if any"""
+        entry = await self.collection.find_one_and_update(
+            {'_id': key},
+            {'$set': {'last_used_at': _now()}, '$inc': {'hits': 1}}
+        )
+        if entry:
+            self.hits += 1
+            return entry['dump_msg_id']
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, file_unique_id: str, dump_msg_id: int):
+        """Remember which dump message holds the output for a key"""
+        try:
+            await self.collection.update_one(
+                {'_id': key},
+                {'$set': {
+                    'file_unique_id': file_unique_id,
+                    'dump_msg_id': dump_msg_id,
+                    'last_used_at': _now()
+                }, '$setOnInsert': {'hits': 0}},
+                upsert=True
+            )
+            self._inserts += 1
+            if self._inserts % PRUNE_EVERY == 0:
+                await self.prune()
+        except Exception as e:
+            logger.error(f"Error saving dedup entry: {e}")
+
+    async def invalidate(self, key: str):
+        """Drop a single entry, e.g. after its dump message turned out to be gone"""
+        result = await self.collection.delete_one({'_id': key})
+        self.invalidations += result.deleted_count
+
+    async def invalidate_dump_messages(self, dump_msg_ids: list):
+        """Drop every entry pointing at deleted dump messages"""
+        result = await self.collection.delete_many({'dump_msg_id': {'$in': list(dump_msg_ids)}})
+        self.invalidations += result.deleted_count
+
+    async def prune(self):
+        """Evict least recently used entries above the size cap"""
+        excess = await self.collection.estimated_document_count() - self.max_entries
+        if excess <= 0:
+            return
+        cursor = self.collection.find({}, {'_id': 1}).sort('last_used_at', 1).limit(excess)
+        ids = [entry['_id'] async for entry in cursor]
+        result = await self.collection.delete_many({'_id': {'$in': ids}})
+        self.evictions += result.deleted_count
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+def _now() -> datetime:
+    # TTL indexes only work on BSON dates
+    return datetime.now(timezone.utc)
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import math
+import os
+import time
+import weakref
+from typing import Callable, Dict, List, Optional
+
+from pyrogram import Client, raw
+from pyrogram.errors import Unauthorized
+from pyrogram.file_id import FileId, FileType
+from pyrogram.session import Auth, Session
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import DOWNLOAD_CONNECTIONS
+except ImportError:
+    DOWNLOAD_CONNECTIONS = 4  # Media connections one large download opens, 1 turns ranged downloads off
+
+try:
+    from config import RANGED_DOWNLOAD_MIN_SIZE
+except ImportError:
+    RANGED_DOWNLOAD_MIN_SIZE = 20 * 1024 * 1024  # Smaller files aren't worth the extra connections
+
+MAX_DOWNLOAD_CONNECTIONS = 8  # Telegram starts refusing media connections beyond a handful per file
+CHUNK_SIZE = 1024 * 1024  # Largest GetFile request, offsets must be multiples of it
+MAX_CHUNK_RETRIES = 3
+
+# Keys authorized on a foreign DC, per client, so only the first download from that DC authorizes one
+_foreign_auth_keys: "weakref.WeakKeyDictionary[Client, Dict[int, bytes]]" = weakref.WeakKeyDictionary()
+_foreign_auth_locks: "weakref.WeakKeyDictionary[Client, Dict[int, asyncio.Lock]]" = weakref.WeakKeyDictionary()
+
+class CdnRedirect(Exception):
+    """The file is served from a CDN DC, which the ranged downloader doesn't speak"""
+
+class RangedDownloader:
+    """Download large files over several media connections, each fetching its own byte ranges"""
+
+    def __init__(self, connections: int = DOWNLOAD_CONNECTIONS):
+        self.connections = max(1, min(connections, MAX_DOWNLOAD_CONNECTIONS))
+        self.downloads = 0
+        self.fallbacks = 0
+        self.last_speeds: List[float] = []  # bytes/s of each connection in the last download
+
+    def wants(self, file_size: int) -> bool:
+        return self.connections > 1 and (file_size or 0) >= RANGED_DOWNLOAD_MIN_SIZE
+
+    async def download(self, client: Client, file_id: str, file_size: int, path: str,
+                       progress: Optional[Callable] = None, progress_args: tuple = ()) -> str:
+        """Download `file_id` into `path` (preallocated to `file_size`), raising CdnRedirect for CDN files"""
+        decoded = FileId.decode(file_id)
+        location = _location(decoded)
+        connections = min(self.connections, math.ceil(file_size / CHUNK_SIZE))
+        offsets = iter(range(0, file_size, CHUNK_SIZE))
+        done = 0
+        speeds = [0.0] * connections
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        sessions = []
+        writes = set()  # Chunk writes running in the thread pool
+        loop = asyncio.get_running_loop()
+        try:
+            os.ftruncate(fd, file_size)
+            sessions = await open_media_sessions(client, decoded.dc_id, connections)
+
+            async def fetch(index: int, session: Session):
+                nonlocal done
+                received = 0
+                started = time.monotonic()
+                # Each connection keeps taking the next free range until none are left
+                for offset in offsets:
+                    r = await _get_chunk(session, location, offset)
+                    if isinstance(r, raw.types.upload.FileCdnRedirect):
+                        raise CdnRedirect()
+                    # Written off the event loop, shielded so the file is never closed under a running write
+                    write = loop.run_in_executor(None, os.pwrite, fd, r.bytes, offset)
+                    writes.add(write)
+                    write.add_done_callback(writes.discard)
+                    await asyncio.shield(write)
+                    received += len(r.bytes)
+                    done += len(r.bytes)
+                    speeds[index] = received / max(time.monotonic() - started, 1e-6)
+                    if progress:
+                        await progress(min(done, file_size), file_size, *progress_args)
+
+            tasks = [asyncio.create_task(fetch(i, session)) for i, session in enumerate(sessions)]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await asyncio.gather(*writes, return_exceptions=True)
+        except BaseException as e:
+            if isinstance(e, Unauthorized):
+                # The DC dropped the key we authorized on it, the next download authorizes a new one
+                forget_media_auth(client, decoded.dc_id)
+            os.close(fd)
+            fd = None
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        finally:
+            if fd is not None:
+                os.close(fd)
+            for session in sessions:
+                await session.stop()
+
+        self.downloads += 1
+        self.last_speeds = speeds
+        logger.info(
+            f"Downloaded {file_size} bytes over {connections} connections: "
+            + ", ".join(f"{speed / (1024 * 1024):.1f}MB/s" for speed in speeds)
+        )
+        return path
+
+    async def download_media(self, client: Client, media, path: str, msg=None,
+                             progress: Optional[Callable] = None, progress_args: tuple = ()) -> str:
+        """Ranged download of a message's media, falling back to pyrogram's download for CDN files"""
+        try:
+            return await self.download(client, media.file_id, media.file_size, path, progress, progress_args)
+        except CdnRedirect:
+            self.fallbacks += 1
+            logger.info(f"{media.file_unique_id} is served from a CDN, downloading it sequentially")
+            return await client.download_media(
+                msg or media.file_id, file_name=path, progress=progress, progress_args=progress_args
+            )
+
+    def stats(self) -> dict:
+        return {
+            'connections': self.connections,
+            'downloads': self.downloads,
+            'fallbacks': self.fallbacks,
+            'last_speeds': self.last_speeds
+        }
+
+def _location(file_id: FileId):
+    if file_id.file_type == FileType.PHOTO:
+        return raw.types.InputPhotoFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+    return raw.types.InputDocumentFileLocation(
+        id=file_id.media_id,
+        access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference,
+        thumb_size=file_id.thumbnail_size
+    )
+
+async def open_media_sessions(client: Client, dc_id: int, count: int) -> List[Session]:
+    """Start `count` media sessions to `dc_id` sharing one authorization"""
+    test_mode = await client.storage.test_mode()
+    if dc_id == await client.storage.dc_id():
+        return await _start_sessions(client, dc_id, await client.storage.auth_key(), test_mode, count)
+
+    keys = _foreign_auth_keys.setdefault(client, {})
+    if dc_id in keys:
+        return await _start_sessions(client, dc_id, keys[dc_id], test_mode, count)
+
+    # Downloads starting together wait for the first one to authorize instead of each making a key
+    async with _foreign_auth_locks.setdefault(client, {}).setdefault(dc_id, asyncio.Lock()):
+        if dc_id in keys:
+            return await _start_sessions(client, dc_id, keys[dc_id], test_mode, count)
+
+        auth_key = await Auth(client, dc_id, test_mode).create()
+        sessions = await _start_sessions(client, dc_id, auth_key, test_mode, count)
+        try:
+            # The key is new to the DC, authorizing it once covers every connection using it
+            exported = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+            await sessions[0].invoke(
+                raw.functions.auth.ImportAuthorization(id=exported.id, bytes=exported.bytes)
+            )
+        except BaseException:
+            for session in sessions:
+                await session.stop()
+            raise
+        keys[dc_id] = auth_key
+        return sessions
+
+def forget_media_auth(client: Client, dc_id: int):
+    _foreign_auth_keys.get(client, {}).pop(dc_id, None)
+
+async def _start_sessions(client: Client, dc_id: int, auth_key: bytes, test_mode: bool, count: int) -> List[Session]:
+    sessions = []
+    try:
+        for _ in range(count):
+            session = Session(client, dc_id, auth_key, test_mode, is_media=True)
+            await session.start()
+            sessions.append(session)
+    except BaseException:
+        for session in sessions:
+            await session.stop()
+        raise
+    return sessions
+
+async def _get_chunk(session: Session, location, offset: int):
+    for attempt in range(MAX_CHUNK_RETRIES):
+        try:
+            return await session.invoke(
+                raw.functions.upload.GetFile(location=location, offset=offset, limit=CHUNK_SIZE),
+                sleep_threshold=30
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            if attempt == MAX_CHUNK_RETRIES - 1:
+                raise
+            logger.warning(f"Retrying chunk at {offset}: {e}")
+            await asyncio.sleep(1)
+
+ranged_downloader = RangedDownloader()
@@ -0,0 +1,93 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from pyrogram import Client, raw
+from pyrogram.types import Message
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import THUMB_UPLOAD_TTL
+except ImportError:
+    THUMB_UPLOAD_TTL = 1800  # Seconds an uploaded thumbnail is reused before Telegram may drop its parts
+
+class FileRefCache:
+    """Telegram references of local assets, keyed by content hash, so each goes up once.
+
+    Photos are reused by file_id. Thumbnails can only be sent as uploaded files, which Telegram
+    keeps for a limited time, so those are reused until they expire or a send reports them missing.
+    """
+
+    def __init__(self, upload_ttl: float = THUMB_UPLOAD_TTL):
+        self.upload_ttl = upload_ttl
+        self._digests: Dict[str, Tuple[tuple, str]] = {}  # path -> (stat, content hash)
+        self._photos: Dict[str, str] = {}  # content hash -> photo file_id
+        self._uploads: Dict[str, Tuple[float, "raw.base.InputFile"]] = {}  # content hash -> (expiry, file)
+        self._uploading: Dict[str, asyncio.Task] = {}
+        self.reused = 0
+        self.uploads = 0
+
+    def digest(self, path: str) -> str:
+        """Content hash of a file, read again only when the file changed"""
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        cached = self._digests.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self._digests[path] = (stamp, digest)
+        return digest
+
+    def photo(self, path: str) -> str:
+        """What to pass as `photo=` for a local image, its file_id once Telegram has it"""
+        file_id = self._photos.get(self.digest(path))
+        if file_id:
+            self.reused += 1
+            return file_id
+        return path
+
+    def remember_photo(self, path: str, message: Optional[Message]):
+        if getattr(message, "photo", None) and os.path.exists(path):
+            self._photos.setdefault(self.digest(path), message.photo.file_id)
+
+    async def input_file(self, client: Client, path: str) -> "raw.base.InputFile":
+        """Uploaded copy of a thumbnail, uploading it only when no live one is cached"""
+        digest = self.digest(path)
+        cached = self._uploads.get(digest)
+        if cached and cached[0] > time.monotonic():
+            self.reused += 1
+            return cached[1]
+
+        # Items of one batch finishing together share the upload
+        task = self._uploading.get(digest)
+        if task is None:
+            task = self._uploading[digest] = asyncio.create_task(self._upload(client, path, digest))
+            task.add_done_callback(lambda _: self._uploading.pop(digest, None))
+        return await asyncio.shield(task)
+
+    async def _upload(self, client: Client, path: str, digest: str) -> "raw.base.InputFile":
+        uploaded = await client.save_file(path)
+        self.uploads += 1
+        self._uploads[digest] = (time.monotonic() + self.upload_ttl, uploaded)
+        return uploaded
+
+    def forget(self, path: str):
+        """Drop everything cached for a file, e.g. after a send reported its upload missing"""
+        cached = self._digests.pop(path, None)
+        if cached:
+            self._photos.pop(cached[1], None)
+            self._uploads.pop(cached[1], None)
+
+    def stats(self) -> dict:
+        return {
+            'photos': len(self._photos),
+            'uploads': self.uploads,
+            'reused': self.reused
+        }
+
+file_refs = FileRefCache()
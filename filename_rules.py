@@ -0,0 +1,94 @@
+import re
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+UNSAFE_CHARS = re.compile(r'[<>:"/\\|?*]')
+WORD_EDGE = r'\b'
+MAX_CACHED_USERS = 1000
+
+class FilenameRules:
+    """A user's replacement rules compiled into one case-insensitive matcher.
+
+    Patterns match literally, as whole words where they start or end with a word character.
+    All rules apply in a single pass, so a replacement is never rewritten by another rule,
+    and a pattern wins over the shorter patterns it starts with.
+    """
+
+    def __init__(self, rules: Tuple[Tuple[str, str], ...]):
+        self.replacements: Dict[str, str] = {}  # Lowercased pattern -> replacement, first rule wins
+        for pattern, replacement in rules:
+            if pattern.startswith('@') or not replacement:
+                # Remove pattern completely
+                pattern, replacement = pattern[1:] if pattern.startswith('@') else pattern, ''
+            if pattern:
+                self.replacements.setdefault(pattern.lower(), replacement)
+
+        # All patterns share one trie, so matching cost grows with length, not count
+        trie: dict = {}
+        for pattern in self.replacements:
+            node = trie
+            for char in pattern:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        self.matcher = re.compile(
+            "|".join((WORD_EDGE if _is_word(char) else '') + re.escape(char) + _render(child, char)
+                     for char, child in trie.items()),
+            re.IGNORECASE
+        ) if trie else None
+
+    def apply(self, name: str) -> str:
+        if self.matcher:
+            name = self.matcher.sub(lambda m: self.replacements.get(m.group(0).lower(), m.group(0)), name)
+        return name
+
+def _is_word(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+def _render(node: dict, last: str) -> str:
+    """Regex for the rest of the words of a trie below `last`, longer words tried first"""
+    branches = [re.escape(char) + _render(child, char) for char, child in node.items() if char]
+    if '' in node:
+        # A word ends here, after every longer one failed, on a word boundary if it ends in a word character
+        branches.append(WORD_EDGE if _is_word(last) else '')
+    if len(branches) == 1:
+        return branches[0]
+    return f"(?:{'|'.join(branches)})"
+
+@lru_cache(maxsize=256)
+def _compile(rules: Tuple[Tuple[str, str], ...]) -> FilenameRules:
+    return FilenameRules(rules)
+
+def compile_rules(replacements: Optional[Dict[str, str]]) -> FilenameRules:
+    """Compiled rules of a replacements dict, shared by every dict with the same rules"""
+    return _compile(tuple((replacements or {}).items()))
+
+class RuleCache:
+    """Compiled rules per user, dropped when the user changes them"""
+
+    def __init__(self, max_users: int = MAX_CACHED_USERS):
+        self.max_users = max_users
+        self._rules: "OrderedDict[int, Tuple[Tuple[Tuple[str, str], ...], FilenameRules]]" = OrderedDict()
+
+    def get(self, user_id: int, replacements: Optional[Dict[str, str]]) -> FilenameRules:
+        items = tuple((replacements or {}).items())
+        cached = self._rules.get(user_id)
+        # Batches pin older settings, so the rules passed in still decide which set applies
+        if cached and cached[0] == items:
+            self._rules.move_to_end(user_id)
+            return cached[1]
+        rules = _compile(items)
+        self._rules[user_id] = (items, rules)
+        self._rules.move_to_end(user_id)
+        while len(self._rules) > self.max_users:
+            self._rules.popitem(last=False)
+        return rules
+
+    def invalidate(self, user_id: int):
+        self._rules.pop(user_id, None)
+
+def sanitize(name: str, rules: FilenameRules) -> str:
+    """Apply replacement rules, then remove characters unsafe in filenames"""
+    return UNSAFE_CHARS.sub('', rules.apply(name)).strip()
+
+rule_cache = RuleCache()
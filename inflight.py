@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+import shutil
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class _Flight:
+    """A download shared by every job asking for the same file"""
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters: Dict[asyncio.Future, tuple] = {}  # waiter -> (progress, progress_args)
+        self.refs = 0
+        self.path: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        self.done = False
+
+class InFlightDownloads:
+    """Coalesce concurrent downloads of the same media into a single transfer"""
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.coalesced = 0
+
+    async def fetch(
+        self,
+        key: str,
+        download: Callable[[Callable], Awaitable[str]],
+        dest_dir: str,
+        progress: Optional[Callable] = None,
+        progress_args: tuple = ()
+    ) -> str:
+        """Return a private copy of the media inside `dest_dir`, downloading it only once per key.
+
+        `download` receives the progress callback to hand to pyrogram and returns the file path.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, download))
+        else:
+            self.coalesced += 1
+
+        waiter = asyncio.get_running_loop().create_future()
+        flight.waiters[waiter] = (progress, progress_args)
+        flight.refs += 1
+        if flight.done:
+            self._resolve(waiter, flight)
+
+        try:
+            shared_path = await waiter
+            os.makedirs(dest_dir, exist_ok=True)
+            dest = os.path.join(dest_dir, os.path.basename(shared_path))
+            try:
+                os.link(shared_path, dest)
+            except OSError:
+                shutil.copyfile(shared_path, dest)
+            return dest
+        finally:
+            flight.waiters.pop(waiter, None)
+            flight.refs -= 1
+            if flight.refs == 0:
+                if flight.done:
+                    self._drop(key, flight)
+                else:
+                    # Nobody is waiting any more, stop transferring and let new requests start afresh
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+                    flight.task.cancel()
+
+    async def _run(self, key: str, flight: _Flight, download: Callable[[Callable], Awaitable[str]]):
+        async def fan_out(current: int, total: int):
+            for waiter, (progress, progress_args) in list(flight.waiters.items()):
+                if not progress or waiter.done():
+                    continue
+                try:
+                    await progress(current, total, *progress_args)
+                except asyncio.CancelledError:
+                    # Only this waiter gave up, the others keep the download going
+                    waiter.cancel()
+
+        try:
+            flight.path = await download(fan_out)
+            if not flight.path:
+                raise IOError("Download returned no file")
+        except BaseException as e:
+            flight.error = e
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            flight.done = True
+            if flight.error and self._flights.get(key) is flight:
+                # Later requests should retry rather than inherit the failure
+                del self._flights[key]
+            for waiter in list(flight.waiters):
+                self._resolve(waiter, flight)
+            if flight.refs == 0:
+                self._drop(key, flight)
+
+    def _resolve(self, waiter: asyncio.Future, flight: _Flight):
+        if waiter.done():
+            return
+        if isinstance(flight.error, asyncio.CancelledError):
+            waiter.cancel()
+        elif flight.error:
+            waiter.set_exception(flight.error)
+        else:
+            waiter.set_result(flight.path)
+
+    def _drop(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if flight.path and os.path.exists(flight.path):
+            try:
+                os.remove(flight.path)
+                os.rmdir(os.path.dirname(flight.path))
+            except OSError as e:
+                logger.error(f"Error removing shared download {flight.path}: {e}")
+
+    def stats(self) -> dict:
+        return {'in_flight': len(self._flights), 'coalesced': self.coalesced}
+
+in_flight = InFlightDownloads()
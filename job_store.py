@@ -0,0 +1,126 @@
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import JOB_RETENTION_DAYS
+except ImportError:
+    JOB_RETENTION_DAYS = 7  # Finished jobs are kept this long
+
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+# Item checkpoints
+UPLOADED = "uploaded"  # In the dump channel, not yet copied to the user
+DELIVERED = "delivered"
+SKIPPED = "skipped"  # Deleted or service message, nothing to deliver
+
+class JobStore:
+    """Batch jobs persisted in MongoDB with a checkpoint per item, so restarts can resume them"""
+
+    def __init__(self, db):
+        self.collection = db.batch_jobs
+
+    async def setup(self):
+        """Create indexes used for resuming and expiry"""
+        await self.collection.create_index('status')
+        # Only finished jobs carry finished_at, running ones never expire
+        await self.collection.create_index('finished_at', expireAfterSeconds=JOB_RETENTION_DAYS * 24 * 3600)
+
+    async def create(self, user_id: int, chat_id: int, message_id: int, source, private: bool,
+                     from_id: int, to_id: int, settings: dict) -> dict:
+        """Record a new batch, `settings` pins the user's settings for its whole run"""
+        job = {
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'message_id': message_id,  # The request, fetched again when resuming
+            'source': source,
+            'private': private,
+            'from_id': from_id,
+            'to_id': to_id,
+            'settings': settings,
+            'items': {},
+            'status': RUNNING,
+            'created_at': _now(),
+            'updated_at': _now()
+        }
+        result = await self.collection.insert_one(job)
+        job['_id'] = result.inserted_id
+        return job
+
+    async def checkpoint(self, job: dict, item_id: int, status: str, dump_msg_id: Optional[int] = None):
+        """Record how far one item got"""
+        entry = {'status': status}
+        if dump_msg_id:
+            entry['dump_msg_id'] = dump_msg_id
+        job['items'][str(item_id)] = entry
+        try:
+            await self.collection.update_one(
+                {'_id': job['_id']},
+                {'$set': {f'items.{item_id}': entry, 'updated_at': _now()}}
+            )
+        except Exception as e:
+            # Losing a checkpoint only costs repeating the item after a restart
+            logger.error(f"Error checkpointing item {item_id} of job {job['_id']}: {e}")
+
+    async def checkpoint_many(self, job: dict, item_ids: list, status: str):
+        """Record the same outcome for several items in one write"""
+        if not item_ids:
+            return
+        entries = {str(item_id): {'status': status} for item_id in item_ids}
+        job['items'].update(entries)
+        try:
+            await self.collection.update_one(
+                {'_id': job['_id']},
+                {'$set': {**{f'items.{key}': entry for key, entry in entries.items()}, 'updated_at': _now()}}
+            )
+        except Exception as e:
+            logger.error(f"Error checkpointing items {item_ids[0]}-{item_ids[-1]} of job {job['_id']}: {e}")
+
+    async def get(self, job_id) -> Optional[dict]:
+        return await self.collection.find_one({'_id': job_id})
+
+    async def set_progress_message(self, job: dict, progress_msg_id: int):
+        """Remember the pinned progress message so whoever finishes the job can update it"""
+        job['progress_msg_id'] = progress_msg_id
+        await self.collection.update_one({'_id': job['_id']}, {'$set': {'progress_msg_id': progress_msg_id}})
+
+    async def finish(self, job: dict, status: str, success: int = 0, failed: int = 0) -> bool:
+        """Close a running job, False if it was already closed elsewhere"""
+        job['status'] = status
+        result = await self.collection.update_one(
+            {'_id': job['_id'], 'status': RUNNING},
+            {'$set': {
+                'status': status,
+                'success': success,
+                'failed': failed,
+                'finished_at': _now(),
+                'updated_at': _now()
+            }}
+        )
+        return result.modified_count == 1
+
+    def running_for_user(self, user_id: int):
+        return self.collection.find({'user_id': user_id, 'status': RUNNING})
+
+    def unfinished(self):
+        """Jobs interrupted by a restart, oldest first"""
+        return self.collection.find({'status': RUNNING}).sort('created_at', 1)
+
+def remaining_items(job: dict) -> list:
+    """Ids of the items of a job that have not been delivered or skipped yet"""
+    items = job.get('items', {})
+    return [
+        item_id for item_id in range(job['from_id'], job['to_id'] + 1)
+        if items.get(str(item_id), {}).get('status') not in (DELIVERED, SKIPPED)
+    ]
+
+def skipped_items(job: dict) -> int:
+    return sum(1 for entry in job.get('items', {}).values() if entry.get('status') == SKIPPED)
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
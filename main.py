@@ -1,5 +1,7 @@
 import asyncio
 import logging
+import time
+from datetime import datetime, timezone
 from typing import Optional, Dict
 from pyrogram import Client, filters, idle
 from pyrogram.errors import UserAlreadyParticipant, InviteHashExpired, UsernameNotOccupied, SessionPasswordNeeded, PhoneCodeInvalid, PhoneCodeExpired
@@ -7,11 +9,46 @@ from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message,
 from pyrogram import utils
 from motor.motor_asyncio import AsyncIOMotorClient
 from config import TOKEN, HASH, ID, USAGE, MONGODB_URI, DUMP_CHANNEL_ID
-from utils import get_message_type, MediaHandler, cleanup_old_status_files
+from utils import get_message_type, get_settings_snapshot, MediaHandler
 from pyrogram.handlers import CallbackQueryHandler
 from task_manager import task_manager
+from batch import run_batch, workers_for_tier
+from dedup_cache import DedupCache
+from inflight import in_flight
+from job_store import JobStore, remaining_items, skipped_items, RUNNING, DONE, CANCELLED, FAILED, UPLOADED, DELIVERED, SKIPPED
+from batch_planner import BatchPlan, plan_batch, PLAN_CHUNK
+from work_queue import MongoWorkQueue, LocalWorkQueue, LeaseWorker
+from progress_bus import progress_bus
+from settings_cache import settings_cache
+from file_refs import file_refs
+from rate_limiter import RateLimiter
+from transfer_pool import transfer_pool
+from downloader import ranged_downloader
+from scheduler import JobScheduler, weight_for_tier
 from settings import Settings
-from video_handler import split_video, get_video_duration
+from session_pool import SessionPool
+
+try:
+    from config import NODE_ROLE
+except ImportError:
+    NODE_ROLE = "all"  # "frontend" only takes requests and queues them, "worker" only processes queued items
+
+try:
+    from config import WORK_QUEUE
+except ImportError:
+    WORK_QUEUE = None  # "mongo" shares batches between nodes, "local" queues them inside this process
+
+try:
+    from config import SESSION_WARMUP_LIMIT
+except ImportError:
+    SESSION_WARMUP_LIMIT = 0  # Most recently used sessions started at boot, the rest start on first use
+
+try:
+    from config import SESSION_WARMUP_CONCURRENCY
+except ImportError:
+    SESSION_WARMUP_CONCURRENCY = 10
+
+LAST_USED_INTERVAL = 3600  # Seconds between last_used writes for one session
 
 def get_peer_type_new(peer_id: int) -> str:
     peer_id_str = str(peer_id)
@@ -52,33 +89,53 @@ def create_cancel_batch_button(user_id: int) -> InlineKeyboardMarkup:
         [InlineKeyboardButton("❌ Cancel Batch", callback_data=f"cancel_batch_{user_id}")]
     ])
 
-async def handle_cancel_batch(client: Client, callback_query: CallbackQuery):
-    """Handle cancel batch button press"""
-    user_id = int(callback_query.data.split('_')[2])
-    processing_messages[user_id] = True
-    await callback_query.answer("Batch processing cancelled")
-
 class TelegramBot:
     def __init__(self):
-        self.bot = Client("mybot", api_id=ID, api_hash=HASH, bot_token=TOKEN)
+        worker_node = NODE_ROLE == "worker"
+        # Worker nodes only send, updates all go to the frontend
+        self.bot = Client("mybot", api_id=ID, api_hash=HASH, bot_token=TOKEN,
+                          in_memory=worker_node, no_updates=worker_node)
+        self.rate_limiter = RateLimiter()
+        self.rate_limiter.install(self.bot)  # Every outgoing bot call shares one budget
         self.mongo_client = AsyncIOMotorClient(MONGODB_URI)
         self.db = self.mongo_client.telegrami_bot
         self.sessions = self.db.sessions
         self.sessions_str = self.db.sessions_str
-        self.user_sessions: Dict[int, Client] = {}  # Cache for active sessions
+        self.user_sessions = SessionPool()  # Started user clients, idle ones are stopped
+        self._session_starts: Dict[int, asyncio.Task] = {}  # Sessions being started, shared by every caller
+        self._last_used_written: Dict[int, float] = {}
+        self.startup_seconds = 0.0
+        self.session_stats = {'started': 0, 'failed': 0, 'start_seconds': 0.0, 'warmed': 0, 'warmup_seconds': 0.0}
         self.user_auth_states: Dict[int, Dict] = {}  # Store user auth states
-        self.semaphore = asyncio.Semaphore(10)  # Limit concurrent operations
+        self.scheduler = JobScheduler()  # Fair share of job slots between users
         self.dump_channel_id = DUMP_CHANNEL_ID  # Assuming a dump_channel_id attribute
-        self.bot.add_handler(CallbackQueryHandler(handle_cancel_batch, filters.regex(r'^cancel_batch_\d+$')))
+        self.bot.add_handler(CallbackQueryHandler(self.handle_cancel_batch, filters.regex(r'^cancel_batch_\d+$')))
         self.settings = Settings(self.db)  # Initialize settings
+        self.dedup = DedupCache(self.db)  # Dump channel messages reused for repeat requests
+        self.jobs = JobStore(self.db)  # Batches checkpointed so they survive restarts
+        self.queue = MongoWorkQueue(self.db) if WORK_QUEUE == "mongo" else LocalWorkQueue() if WORK_QUEUE == "local" else None
+        self.worker = None
+        if self.queue and NODE_ROLE != "frontend":
+            self.worker = LeaseWorker(self.queue, self.process_queued_item, after=self.finish_queued_item)
+        self._request_messages: Dict = {}  # job id -> request message, for queued items
+        self._queued_plans: Dict = {}  # job id -> plan of the chunk of queued items this node works through
 
     async def initialize(self):
         """Initialize the bot and load sessions"""
         await self.bot.start()
         logger.info("Bot client initialized")
         
-        # Clean up old status files
-        await cleanup_old_status_files()
+        await self.dedup.setup()
+        transfer_pool.start()  # No-op unless TRANSFER_PROCESSES is set
+        self.user_sessions.start()
+        await self.jobs.setup()
+        if self.queue:
+            await self.queue.setup()
+
+        # Forget cached dump messages as soon as they are deleted
+        @self.bot.on_deleted_messages(filters.chat(self.dump_channel_id))
+        async def dump_deleted_handler(client, messages):
+            await self.dedup.invalidate_dump_messages([m.id for m in messages])
         
         # Add settings handlers
         @self.bot.on_message(filters.command("uset"))
@@ -101,31 +158,30 @@ class TelegramBot:
         async def replacement_handler(client, message):
             await self.settings.set_replacement(client, message)
             
-        # Load existing sessions from MongoDB
-        async for session in self.sessions.find():
-            try:
-                user_id = session['user_id']
-                string_session = session['session_string']
-                
-                # Create client with stored session
-                user_client = Client(
-                    f"user_{user_id}",
-                    api_id=ID,
-                    api_hash=HASH,
-                    session_string=string_session
-                )
-                await user_client.start()
-                
-                # Store in memory cache
-                self.user_sessions[user_id] = user_client
-                logger.info(f"Loaded session for user {user_id}")
-            except Exception as e:
-                logger.error(f"Error loading session for user {session.get('user_id')}: {e}")
+        # Stored sessions start on first use, only the most recently used ones are warmed up
+        await self.sessions.create_index('last_used')
+        # Shared thumbnail files are kept while any user still points at their hash
+        await self.db.users.create_index('thumb_hash', sparse=True)
+        if SESSION_WARMUP_LIMIT > 0:
+            asyncio.create_task(self.warm_up_sessions())
 
         @self.bot.on_callback_query()
         async def callback_handler(client, callback_query):
             await self.settings.handle_callback(client, callback_query)
 
+        # Pick up batches interrupted by the last shutdown
+        if not self.queue:
+            async for job in self.jobs.unfinished():
+                asyncio.create_task(self.resume_job(job))
+        elif WORK_QUEUE == "local" and NODE_ROLE == "all":
+            # The in-process queue died with the last process, queue what is left again
+            async for job in self.jobs.unfinished():
+                await self.queue.enqueue(job['_id'], remaining_items(job))
+        # Queued items of dead nodes come back on their own once their leases expire
+
+        if self.worker:
+            self.worker.start()
+
     async def save_session(self, user_id: int, string_session: str):
         """Save session to MongoDB"""
         await self.sessions.update_one(
@@ -142,82 +198,268 @@ class TelegramBot:
     async def delete_session(self, user_id: int):
         """Delete session from MongoDB"""
         await self.sessions.delete_one({'user_id': user_id})
+        self._last_used_written.pop(user_id, None)
         logger.info(f"Deleted session for user {user_id}")
 
+    async def has_session(self, user_id: int) -> bool:
+        """Whether the user is signed in, started or not"""
+        return user_id in self.user_sessions or await self.sessions.find_one({'user_id': user_id}, {'_id': 1}) is not None
+
     async def get_user_session(self, user_id: int) -> Optional[Client]:
-        """Get or create user session"""
-        if user_id not in self.user_sessions:
-            # Try to load from MongoDB
-            session = await self.sessions.find_one({'user_id': user_id})
-            if session:
-                try:
-                    user_client = Client(
-                        f"user_{user_id}",
-                        api_id=ID,
-                        api_hash=HASH,
-                        session_string=session['session_string']
-                    )
-                    await user_client.start()
-                    self.user_sessions[user_id] = user_client
-                    return user_client
-                except Exception as e:
-                    logger.error(f"Error loading session for user {user_id}: {e}")
-                    await self.delete_session(user_id)
+        """Get or create user session, starting it again if the pool stopped it"""
+        user_client = self.user_sessions.get(user_id)
+        if user_client:
+            await self._touch_session(user_id)
+            return user_client
+
+        # Concurrent requests of one user wait for the same start
+        start = self._session_starts.get(user_id)
+        if start is None:
+            start = self._session_starts[user_id] = asyncio.create_task(self._start_session(user_id))
+            start.add_done_callback(lambda _: self._session_starts.pop(user_id, None))
+        return await asyncio.shield(start)
+
+    async def _start_session(self, user_id: int) -> Optional[Client]:
+        """Start a stored session, forgetting it when it no longer works"""
+        session = await self.sessions.find_one({'user_id': user_id})
+        if not session:
             return None
-        return self.user_sessions[user_id]
 
-    async def handle_private_message(self, message: Message, chatid: int, msgid: int):
-        """Handle private message processing"""
-        async with self.semaphore:
-            user_session = await self.get_user_session(message.from_user.id)
-            if not user_session:
+        started = time.monotonic()
+        try:
+            user_client = Client(
+                f"user_{user_id}",
+                api_id=ID,
+                api_hash=HASH,
+                session_string=session['session_string']
+            )
+            await user_client.start()
+        except Exception as e:
+            self.session_stats['failed'] += 1
+            logger.error(f"Error loading session for user {user_id}: {e}")
+            await self.delete_session(user_id)
+            return None
+
+        self.session_stats['started'] += 1
+        self.session_stats['start_seconds'] += time.monotonic() - started
+        await self.user_sessions.put(user_id, user_client)
+        logger.info(f"Loaded session for user {user_id}")
+        await self._touch_session(user_id)
+        return user_client
+
+    async def _touch_session(self, user_id: int):
+        """Record when a session was last used, for the warm-up at the next start"""
+        now = time.monotonic()
+        if now - self._last_used_written.get(user_id, -LAST_USED_INTERVAL) < LAST_USED_INTERVAL:
+            return
+        self._last_used_written[user_id] = now
+        try:
+            await self.sessions.update_one(
+                {'user_id': user_id},
+                {'$set': {'last_used': datetime.now(timezone.utc)}}
+            )
+        except Exception as e:
+            logger.error(f"Error recording session use of user {user_id}: {e}")
+
+    async def warm_up_sessions(self):
+        """Start the most recently used sessions a few at a time"""
+        started = time.monotonic()
+        # Starting more than the pool keeps would evict the sessions warmed first
+        pool_size = self.user_sessions.max_size
+        limit = min(SESSION_WARMUP_LIMIT, pool_size) if pool_size else SESSION_WARMUP_LIMIT
+        cursor = self.sessions.find({'last_used': {'$exists': True}}, {'user_id': 1})
+        user_ids = [doc['user_id'] async for doc in cursor.sort('last_used', -1).limit(limit)]
+        slots = asyncio.Semaphore(SESSION_WARMUP_CONCURRENCY)
+
+        async def warm(user_id: int):
+            async with slots:
+                return await self.get_user_session(user_id)
+
+        results = await asyncio.gather(*(warm(user_id) for user_id in user_ids), return_exceptions=True)
+        self.session_stats['warmed'] = sum(1 for r in results if isinstance(r, Client))
+        self.session_stats['warmup_seconds'] = time.monotonic() - started
+        logger.info(f"Warmed up {self.session_stats['warmed']} of {len(user_ids)} sessions "
+                    f"in {self.session_stats['warmup_seconds']:.1f}s")
+
+    async def handle_private_message(self, message: Message, chatid: int, msgid: int, weight: float = 1,
+                                     settings: Optional[dict] = None) -> bool:
+        """Handle private message processing, True once it reached the user"""
+        item = await self.prefetch_private_message(message, chatid, msgid, weight, settings)
+        if not item:
+            return False
+        await self.upload_private_message(message, item, weight)
+        return await self.deliver_private_message(message, item, weight)
+
+    async def prefetch_private_message(self, message: Message, chatid: int, msgid: int, weight: float = 1,
+                                       settings: Optional[dict] = None, msg: Optional[Message] = None) -> Optional[Dict]:
+        """Fetch a private message and download its media ahead of delivery.
+
+        Only the download holds a scheduler slot, picked by the media size known from the metadata.
+        """
+        user_session = await self.get_user_session(message.from_user.id)
+        if not user_session:
+            await self.bot.send_message(
+                message.chat.id,
+                "**Please sign in first using /signin**",
+                reply_to_message_id=message.id
+            )
+            return None
+
+        try:
+            if msg is None:  # Not fetched ahead by the batch planner
+                msg = await user_session.get_messages(chatid, msgid)
+            if msg is None:
                 await self.bot.send_message(
                     message.chat.id,
-                    "**Please sign in first using /signin**",
+                    "**Message not found. The message may have been deleted or you may not have access to it.**",
                     reply_to_message_id=message.id
                 )
-                return
+                return None
 
-            try:
-                msg = await user_session.get_messages(chatid, msgid)
-                if msg is None:
-                    await self.bot.send_message(
-                        message.chat.id,
-                        "**Message not found. The message may have been deleted or you may not have access to it.**",
-                        reply_to_message_id=message.id
-                    )
-                    return
+            msg_type = get_message_type(msg)
+            size = getattr(getattr(msg, msg_type.lower(), None), "file_size", 0) or 0
+            item = {"msg": msg, "type": msg_type, "size": size, "handler": None, "prepared": None, "dump_msg": None}
 
-                msg_type = get_message_type(msg)
+            is_large_video = msg_type == "Video" and msg.video and msg.video.file_size > 2*1024*1024*1024  # 2GB
+            if is_large_video:
+                # Downloaded, split and uploaded part by part on delivery
+                item["split"] = MediaHandler(self.bot, user_session, db=self.db, dedup=self.dedup, settings=settings)
+            elif msg_type != "Text":
+                media_handler = MediaHandler(self.bot, user_session, db=self.db, dedup=self.dedup, settings=settings)
+                async with self.scheduler.slot(message.from_user.id, size=size, weight=weight):
+                    prepared = await media_handler.prefetch_media(message, msg, msg_type)
+                if not prepared:
+                    return None
+                item["handler"] = media_handler
+                item["prepared"] = prepared
+            return item
+        except Exception as e:
+            logger.error(f"Error handling private message: {e}")
+            await self.bot.send_message(
+                message.chat.id,
+                f"**Error** : __{e}__",
+                reply_to_message_id=message.id
+            )
+            return None
 
-                # Special handling for large videos
-                if msg_type == "Video" and msg.video and msg.video.file_size > 2*1024*1024*1024:  # 2GB
-                    await self.handle_large_video(message, msg)
-                    return
-                
-                if msg_type == "Text":
-                    await self.bot.send_message(
-                        message.chat.id,
-                        msg.text,
-                        entities=msg.entities,
-                        reply_to_message_id=message.id
-                    )
-                    return
+    async def restore_uploaded_message(self, dump_msg_id: int, settings: Optional[dict] = None) -> Optional[Dict]:
+        """Rebuild an item whose upload finished before a restart, None if its dump message is gone"""
+        dump_msg = await self.bot.get_messages(self.dump_channel_id, dump_msg_id)
+        if not dump_msg or dump_msg.empty:
+            return None
+        media_handler = MediaHandler(self.bot, db=self.db, dedup=self.dedup, settings=settings)
+        return {"msg": None, "type": None, "size": 0, "handler": media_handler, "prepared": None, "dump_msg": dump_msg}
 
-                media_handler = MediaHandler(self.bot, user_session, db=self.db)  # Pass db instance when creating MediaHandler
-                await media_handler.handle_media(message, msg, msg_type)
-            except Exception as e:
-                logger.error(f"Error handling private message: {e}")
+    async def prefetch_album(self, message: Message, msgs: list, weight: float = 1,
+                             settings: Optional[dict] = None) -> Optional[Dict]:
+        """Download every member of an album so it can be sent as one media group"""
+        user_session = await self.get_user_session(message.from_user.id)
+        if not user_session:
+            await self.bot.send_message(
+                message.chat.id,
+                "**Please sign in first using /signin**",
+                reply_to_message_id=message.id
+            )
+            return None
+
+        media_handler = MediaHandler(self.bot, user_session, db=self.db, dedup=self.dedup, settings=settings)
+        item = {"album": True, "msgs": msgs, "types": [get_message_type(msg) for msg in msgs], "size": 0,
+                "handler": media_handler, "prepared": [], "dump_msgs": None}
+        try:
+            for msg, msg_type in zip(msgs, item["types"]):
+                size = getattr(msg, msg_type.lower()).file_size or 0
+                async with self.scheduler.slot(message.from_user.id, size=size, weight=weight):
+                    prepared = await media_handler.prefetch_media(message, msg, msg_type, album=True)
+                if not prepared:
+                    # Already reported, the album can't be sent without it
+                    await self.discard_private_message(message, item)
+                    return None
+                item["prepared"].append(prepared)
+                item["size"] += size
+            return item
+        except BaseException:
+            await self.discard_private_message(message, item)
+            raise
+
+    async def restore_uploaded_album(self, dump_msg_ids: list, settings: Optional[dict] = None) -> Optional[Dict]:
+        """Rebuild an album whose upload finished before a restart, None if any dump message is gone"""
+        dump_msgs = await self.bot.get_messages(self.dump_channel_id, dump_msg_ids)
+        if any(not dump_msg or dump_msg.empty for dump_msg in dump_msgs):
+            return None
+        media_handler = MediaHandler(self.bot, db=self.db, dedup=self.dedup, settings=settings)
+        return {"album": True, "msgs": None, "types": None, "size": 0, "handler": media_handler,
+                "prepared": [], "dump_msgs": dump_msgs}
+
+    async def upload_private_message(self, message: Message, item: Dict, weight: float = 1):
+        """Upload prefetched media to the dump channel, ahead of in-order delivery"""
+        if item.get("album"):
+            if item["prepared"]:
+                prepared, item["prepared"] = item["prepared"], []
+                async with self.scheduler.slot(message.from_user.id, size=item["size"], weight=weight):
+                    item["dump_msgs"] = await item["handler"].upload_album(message, item["msgs"], item["types"], prepared)
+            return
+        if item["prepared"]:
+            prepared, item["prepared"] = item["prepared"], None
+            async with self.scheduler.slot(message.from_user.id, size=item["size"], weight=weight):
+                item["dump_msg"] = await item["handler"].upload_media(message, item["msg"], item["type"], prepared)
+
+    async def deliver_private_message(self, message: Message, item: Dict, weight: float = 1) -> bool:
+        """Send a prefetched private message to the user, False if it didn't get there"""
+        if item.get("album"):
+            # A failed upload was reported already
+            return bool(item["dump_msgs"]) and await item["handler"].send_album_to_user(message, item["dump_msgs"])
+        msg, msg_type = item["msg"], item["type"]
+        try:
+            if item["handler"]:
+                return bool(item["dump_msg"]) and await item["handler"].send_to_user(message, item["dump_msg"])
+
+            if msg_type == "Text":
                 await self.bot.send_message(
                     message.chat.id,
-                    f"**Error** : __{e}__",
+                    msg.text,
+                    entities=msg.entities,
                     reply_to_message_id=message.id
                 )
+                return True
 
-    async def handle_public_message(self, message: Message, username: str, msgid: int):
-        """Handle public message processing"""
-        async with self.semaphore:
-            try:
+            # Special handling for large videos
+            if item.get("split"):
+                async with self.scheduler.slot(message.from_user.id, size=item["size"], weight=weight):
+                    return await item["split"].handle_large_video(message, msg)
+            return False
+        except Exception as e:
+            logger.error(f"Error handling private message: {e}")
+            await self.bot.send_message(
+                message.chat.id,
+                f"**Error** : __{e}__",
+                reply_to_message_id=message.id
+            )
+            return False
+
+    async def discard_private_message(self, message: Message, item: Dict):
+        """Clean up a prefetched private message that will not be delivered"""
+        if item.get("album"):
+            prepared, item["prepared"] = item["prepared"], []
+            for member in prepared:
+                await item["handler"].discard_media(message, member)
+        elif item["prepared"]:
+            await item["handler"].discard_media(message, item["prepared"])
+
+    async def handle_public_message(self, message: Message, username: str, msgid: int, weight: float = 1,
+                                    settings: Optional[dict] = None) -> bool:
+        """Handle public message processing, True once it reached the user"""
+        item = await self.upload_public_message(message, username, msgid, weight, settings)
+        return bool(item) and await self.deliver_public_message(message, item, weight)
+
+    async def upload_public_message(self, message: Message, username: str, msgid: int, weight: float = 1,
+                                    settings: Optional[dict] = None) -> Optional[Dict]:
+        """Copy a public message into the dump channel, ahead of in-order delivery.
+
+        Messages the bot can't copy go through the user session like private ones.
+        """
+        fallback = False
+        try:
+            async with self.scheduler.slot(message.from_user.id, weight=weight):
                 # Try to get message directly with bot first
                 try:
                     msg = await self.bot.get_messages(username, msgid)
@@ -227,54 +469,81 @@ class TelegramBot:
                         "**The username is not occupied by anyone**",
                         reply_to_message_id=message.id
                     )
-                    return
+                    return None
 
                 try:
-                    # First forward to dump channel
+                    # First forward to dump channel, the user gets it on delivery
                     if '?single' not in message.text:
                         dump_msg = await self.bot.copy_message(
                             self.dump_channel_id,
                             msg.chat.id,
                             msg.id
                         )
-                        # Then forward to user
-                        await self.bot.copy_message(
-                            message.chat.id,
-                            self.dump_channel_id,
-                            dump_msg.id,
-                            reply_to_message_id=message.id
-                        )
-                    else:
-                        dump_msgs = await self.bot.copy_media_group(
-                            self.dump_channel_id,
-                            msg.chat.id,
-                            msg.id
-                        )
-                        # Then forward to user
-                        await self.bot.copy_media_group(
-                            message.chat.id,
-                            self.dump_channel_id,
-                            dump_msgs[0].id,
-                            reply_to_message_id=message.id
-                        )
+                        return {"public": True, "album": False, "dump_msg_id": dump_msg.id}
+                    dump_msgs = await self.bot.copy_media_group(
+                        self.dump_channel_id,
+                        msg.chat.id,
+                        msg.id
+                    )
+                    return {"public": True, "album": True, "dump_msg_id": dump_msgs[0].id}
                 except:
                     # If direct copy fails, try using user session
-                    user_session = await self.get_user_session(message.from_user.id)
-                    if not user_session:
-                        await self.bot.send_message(
-                            message.chat.id,
-                            "**Please sign in first using /signin**",
-                            reply_to_message_id=message.id
-                        )
-                        return
-                    await self.handle_private_message(message, username, msgid)
-            except Exception as e:
-                logger.error(f"Error handling public message: {e}")
+                    fallback = True
+
+            # The private path takes its own slot, so ours is released first
+            user_session = await self.get_user_session(message.from_user.id)
+            if not user_session:
                 await self.bot.send_message(
                     message.chat.id,
-                    f"**Error** : __{e}__",
+                    "**Please sign in first using /signin**",
                     reply_to_message_id=message.id
                 )
+                return None
+            item = await self.prefetch_private_message(message, username, msgid, weight, settings)
+            if item:
+                try:
+                    await self.upload_private_message(message, item, weight)
+                except BaseException:
+                    await self.discard_private_message(message, item)
+                    raise
+            return item
+        except Exception as e:
+            logger.error(f"Error handling public message: {e}")
+            await self.bot.send_message(
+                message.chat.id,
+                f"**Error** : __{e}__",
+                reply_to_message_id=message.id
+            )
+            return None
+
+    async def deliver_public_message(self, message: Message, item: Dict, weight: float = 1) -> bool:
+        """Copy a public message from the dump channel to the user, False if it didn't get there"""
+        if not item.get("public"):
+            return await self.deliver_private_message(message, item, weight)
+        try:
+            if item["album"]:
+                await self.bot.copy_media_group(
+                    message.chat.id,
+                    self.dump_channel_id,
+                    item["dump_msg_id"],
+                    reply_to_message_id=message.id
+                )
+            else:
+                await self.bot.copy_message(
+                    message.chat.id,
+                    self.dump_channel_id,
+                    item["dump_msg_id"],
+                    reply_to_message_id=message.id
+                )
+            return True
+        except Exception as e:
+            logger.error(f"Error handling public message: {e}")
+            await self.bot.send_message(
+                message.chat.id,
+                f"**Error** : __{e}__",
+                reply_to_message_id=message.id
+            )
+            return False
 
     async def handle_join_chat(self, message: Message):
         """Handle chat joining"""
@@ -325,73 +594,309 @@ class TelegramBot:
             fromID = int(temp[0].strip())
             toID = int(temp[1].strip()) if len(temp) > 1 else fromID
 
-            # Calculate total messages
-            total_messages = toID - fromID + 1
-            
+            private = "https://t.me/c/" in message.text or "https://t.me/b/" in message.text
+            if private:
+                source = int("-100" + datas[4]) if "https://t.me/c/" in message.text else datas[4]
+            else:
+                source = datas[3]
+
+            # The whole batch runs with the settings the user had when sending the link
             user_id = message.from_user.id
-            processing_messages[user_id] = False  # Initialize cancellation status
-            
-            progress_message = await self.bot.send_message(
-                message.chat.id,
-                f"📥 **Processing {total_messages} messages...**",
-                reply_to_message_id=message.id,
-                reply_markup=create_cancel_batch_button(user_id)  # Add cancel button
+            settings = await get_settings_snapshot(user_id, self.db)
+            job = await self.jobs.create(
+                user_id, message.chat.id, message.id, source, private, fromID, toID, settings
             )
-            
-            try:
-                await self.bot.pin_chat_message(message.chat.id, progress_message.id, both_sides=True, disable_notification=True)
-            except Exception as e:
-                logger.error(f"Error pinning message: {e}")
-
-            processed = 0
-            success = 0
-            failed = 0
-
-            # Process messages one by one
-            for msgid in range(fromID, toID + 1):
-                if processing_messages.get(user_id, False):
-                    logger.info(f"Batch processing cancelled by user {user_id}")
-                    await progress_message.edit_text("❌ Batch processing cancelled.")
-                    break
-                try:
-                    if "https://t.me/c/" in message.text:
-                        chatid = int("-100" + datas[4])
-                        await self.handle_private_message(message, chatid, msgid)
-                    elif "https://t.me/b/" in message.text:
-                        username = datas[4]
-                        await self.handle_private_message(message, username, msgid)
-                    else:
-                        username = datas[3]
-                        await self.handle_public_message(message, username, msgid)
-                    
-                    success += 1
-                except Exception as e:
-                    logger.error(f"Error processing message {msgid}: {e}")
-                    failed += 1
-                
-                processed += 1
-                
-                # Add delay between messages
-                if processed < total_messages:
-                    await asyncio.sleep(2)  # Rate limiting between messages
-
-            # Final progress update
-            if not processing_messages.get(user_id, False):
-                await progress_message.edit_text(
-                    f"✅ **Completed processing {total_messages} messages!**\n"
-                    f"Successfully forwarded: {success}\n"
-                    f"Failed: {failed}"
-                )
-            
+            if self.queue:
+                # Worker nodes pick the items up, whichever finishes the last one closes the job
+                plan = await self.plan_job(message, job, remaining_items(job))
+                await self.open_progress_message(message, job, plan)
+                await self.queue.enqueue(job['_id'], plan.units() if plan else remaining_items(job))  # Albums stay whole
+            else:
+                await self.run_job(message, job)
+
+    async def handle_cancel_batch(self, client: Client, callback_query: CallbackQuery):
+        """Handle cancel batch button press"""
+        user_id = int(callback_query.data.split('_')[2])
+        if self.queue:
+            # Items already claimed finish, the rest are never handed out
+            async for job in self.jobs.running_for_user(user_id):
+                await self.queue.cancel(job['_id'])
+                counts = await self.queue.job_counts(job['_id'])
+                await self.close_job(job, counts.get('done', 0), counts.get('failed', 0), cancelled=True)
+        else:
+            processing_messages[user_id] = True
+        await callback_query.answer("Batch processing cancelled")
+
+    async def resume_job(self, job: Dict):
+        """Continue a batch interrupted by a restart from its last checkpoint"""
+        try:
+            message = await self.request_message(job)
+            if not message:
+                logger.warning(f"Request of job {job['_id']} is gone, dropping the job")
+                await self.jobs.finish(job, FAILED)
+                return
+            logger.info(f"Resuming job {job['_id']} of user {job['user_id']}")
+            await self.run_job(message, job)
+        except Exception as e:
+            logger.error(f"Error resuming job {job['_id']}: {e}")
+
+    async def request_message(self, job: Dict) -> Optional[Message]:
+        """The message a job was requested with, None if it no longer exists"""
+        message = self._request_messages.get(job['_id'])
+        if message is None:
+            message = await self.bot.get_messages(job['chat_id'], job['message_id'])
+            if not message or message.empty or not message.from_user:
+                return None
+            if len(self._request_messages) >= 1000:
+                self._request_messages.clear()
+            self._request_messages[job['_id']] = message
+        return message
+
+    async def plan_job(self, message: Message, job: Dict, item_ids: list) -> Optional[BatchPlan]:
+        """Fetch the metadata of a private batch in bulk and skip what can't be delivered"""
+        if not job['private'] or not item_ids:
+            return None
+        user_session = await self.get_user_session(message.from_user.id)
+        if not user_session:
+            return None
+        try:
+            plan = await plan_batch(user_session, job['source'], item_ids)
+        except Exception as e:
+            # Items fetch their own message when there is no plan
+            logger.error(f"Error planning job {job['_id']}: {e}")
+            return None
+        await self.jobs.checkpoint_many(job, plan.skipped, SKIPPED)
+        return plan
+
+    async def open_progress_message(self, message: Message, job: Dict, plan: Optional[BatchPlan] = None) -> Message:
+        """Send and pin the progress message of a job"""
+        total_messages = job['to_id'] - job['from_id'] + 1
+        left = len(remaining_items(job))
+        text = (
+            f"📥 **Processing {total_messages} messages...**" if left + skipped_items(job) == total_messages else
+            f"📥 **Resuming: {left} of {total_messages} messages left...**"
+        )
+        if plan:
+            text += "\n\n" + plan.describe()
+        progress_message = await self.bot.send_message(
+            message.chat.id,
+            text,
+            reply_to_message_id=message.id,
+            reply_markup=create_cancel_batch_button(message.from_user.id)  # Add cancel button
+        )
+        await self.jobs.set_progress_message(job, progress_message.id)
+
+        try:
+            await self.bot.pin_chat_message(message.chat.id, progress_message.id, both_sides=True, disable_notification=True)
+        except Exception as e:
+            logger.error(f"Error pinning message: {e}")
+        return progress_message
+
+    async def close_job(self, job: Dict, success: int, failed: int, cancelled: bool = False):
+        """Mark a job finished and update its progress message, once across all nodes"""
+        if not await self.jobs.finish(job, CANCELLED if cancelled else DONE, success, failed):
+            return
+        if self.queue:
+            await self.queue.forget(job['_id'])
+        self._request_messages.pop(job['_id'], None)
+        self._queued_plans.pop(job['_id'], None)
+        progress_msg_id = job.get('progress_msg_id')
+        if not progress_msg_id:
+            return
+
+        if cancelled:
+            logger.info(f"Batch processing cancelled by user {job['user_id']}")
+            text = "❌ Batch processing cancelled."
+        else:
+            text = (
+                f"✅ **Completed processing {job['to_id'] - job['from_id'] + 1} messages!**\n"
+                f"Successfully forwarded: {success}\n"
+                f"Failed: {failed}"
+            )
+            skipped = skipped_items(job)
+            if skipped:
+                text += f"\nSkipped (deleted or service): {skipped}"
+        try:
+            await self.bot.edit_message_text(job['chat_id'], progress_msg_id, text)
+            await self.bot.unpin_chat_message(job['chat_id'], progress_msg_id)
+        except Exception as e:
+            logger.error(f"Error updating progress message: {e}")
+
+    def job_stages(self, message: Message, job: Dict, weight: float, plan: Optional[BatchPlan] = None):
+        """The prefetch, upload, deliver and discard steps of one item of a job"""
+        settings = job['settings']
+
+        if job['private']:
+            chatid = job['source']
+
+            async def prefetch_album(ids):
+                checkpoints = [job['items'].get(str(msgid), {}) for msgid in ids]
+                if all(c.get('status') == UPLOADED for c in checkpoints):
+                    item = await self.restore_uploaded_album([c['dump_msg_id'] for c in checkpoints], settings)
+                    if item:
+                        return item
+                msgs = [plan.pop_message(msgid) if plan else None for msgid in ids]
+                if None in msgs:
+                    # Not in the plan, e.g. a queued album retried after its plan was used up
+                    user_session = await self.get_user_session(message.from_user.id)
+                    if user_session:
+                        msgs = await user_session.get_messages(chatid, list(ids))
+                return await self.prefetch_album(message, msgs, weight, settings)
+
+            async def prefetch(msgid):
+                if isinstance(msgid, tuple):
+                    return await prefetch_album(msgid)
+                checkpoint = job['items'].get(str(msgid), {})
+                if checkpoint.get('status') == UPLOADED:
+                    # Uploaded before the restart, deliver the dump copy instead of transferring again
+                    item = await self.restore_uploaded_message(checkpoint['dump_msg_id'], settings)
+                    if item:
+                        return item
+                msg = plan.pop_message(msgid) if plan else None
+                return await self.prefetch_private_message(message, chatid, msgid, weight, settings, msg)
+
+            async def upload(msgid, item):
+                if item:
+                    await self.upload_private_message(message, item, weight)
+                    if item.get("album"):
+                        if item["dump_msgs"] and item["msgs"]:
+                            for member_id, dump_msg in zip(msgid, item["dump_msgs"]):
+                                await self.jobs.checkpoint(job, member_id, UPLOADED, dump_msg.id)
+                    elif item["dump_msg"] and item["msg"]:
+                        await self.jobs.checkpoint(job, msgid, UPLOADED, item["dump_msg"].id)
+                return item
+
+            async def deliver(msgid, item):
+                # Failures were reported to the user, they stay pending so a resumed job tries again
+                if not item or not await self.deliver_private_message(message, item, weight):
+                    raise RuntimeError(f"Message {msgid} was not delivered")
+                await self.jobs.checkpoint_many(job, list(msgid) if isinstance(msgid, tuple) else [msgid], DELIVERED)
+
+            async def discard(item):
+                await self.discard_private_message(message, item)
+        else:
+            username = job['source']
+
+            async def prefetch(msgid):
+                return None
+
+            async def upload(msgid, item):
+                # Copies into the dump channel run concurrently, only the copy to the user waits its turn
+                return await self.upload_public_message(message, username, msgid, weight, settings)
+
+            async def deliver(msgid, item):
+                if not item or not await self.deliver_public_message(message, item, weight):
+                    raise RuntimeError(f"Message {msgid} was not delivered")
+                await self.jobs.checkpoint(job, msgid, DELIVERED)
+
+            async def discard(item):
+                if not item.get("public"):
+                    await self.discard_private_message(message, item)
+
+        return prefetch, upload, deliver, discard
+
+    async def run_job(self, message: Message, job: Dict):
+        """Run the remaining items of a batch job in this process, checkpointing each one"""
+        # The session pool keeps the user's client started until the batch is over
+        async with self.user_sessions.hold(message.from_user.id):
+            await self._run_job(message, job)
+
+    async def _run_job(self, message: Message, job: Dict):
+        user_id = message.from_user.id
+        delivered = sum(1 for entry in job['items'].values() if entry.get('status') == DELIVERED)
+
+        # One metadata round trip per 200 messages instead of one per item
+        plan = await self.plan_job(message, job, remaining_items(job))
+        item_ids = plan.units() if plan else remaining_items(job)  # Albums run as one unit
+
+        processing_messages[user_id] = False  # Initialize cancellation status
+        await self.open_progress_message(message, job, plan)
+
+        is_cancelled = lambda: processing_messages.get(user_id, False)
+        tier = job['settings'].get('tier')
+        workers = workers_for_tier(tier)
+        weight = weight_for_tier(tier)
+
+        # Download upcoming messages while others upload, then deliver in order
+        prefetch, upload, deliver, discard = self.job_stages(message, job, weight, plan)
+
+        # Pacing comes from the shared rate limiter
+        success, failed, cancelled = await run_batch(
+            item_ids, prefetch, upload, deliver, discard,
+            is_cancelled, workers=workers
+        )
+        if plan:
+            # Units are albums or single messages, count messages instead
+            success = sum(1 for entry in job['items'].values() if entry.get('status') == DELIVERED) - delivered
+            failed = len(plan.item_ids) - success if not cancelled else failed
+        await self.close_job(job, success + delivered, failed, cancelled)
+
+        if user_id in processing_messages:
+            del processing_messages[user_id]
+
+    async def process_queued_item(self, queued: Dict):
+        """Run one item claimed from the shared queue by this node"""
+        job = await self.jobs.get(queued['job_id'])
+        if not job or job['status'] != RUNNING:
+            return  # Cancelled or already closed
+        # Albums come back from MongoDB as lists, the stages take them as tuples
+        msgid = tuple(queued['item_id']) if isinstance(queued['item_id'], (list, tuple)) else queued['item_id']
+        finished = lambda: all(
+            job['items'].get(str(item_id), {}).get('status') in (DELIVERED, SKIPPED)
+            for item_id in (msgid if isinstance(msgid, tuple) else [msgid])
+        )
+        if finished():
+            return  # Delivered by a node that died before completing the item, or deleted since
+
+        message = await self.request_message(job)
+        if not message:
+            raise ValueError("Request message is gone")
+
+        plan = await self.queued_plan(message, job, msgid)
+        if finished():
+            return
+
+        # Fairness between users still applies through this node's scheduler
+        weight = weight_for_tier(job['settings'].get('tier'))
+        prefetch, upload, deliver, discard = self.job_stages(message, job, weight, plan)
+
+        async with self.user_sessions.hold(job['user_id']):
+            item = await prefetch(msgid)
             try:
-                await self.bot.unpin_chat_message(message.chat.id, progress_message.id)
-            except Exception as e:
-                logger.error(f"Error unpinning message: {e}")
-            
-            if user_id in processing_messages:
-                del processing_messages[user_id]
+                item = await upload(msgid, item)
+            except asyncio.CancelledError:
+                if item is not None:
+                    await discard(item)
+                raise
+        await deliver(msgid, item)
+
+    async def queued_plan(self, message: Message, job: Dict, msgid) -> Optional[BatchPlan]:
+        """Plan holding the messages of a claimed item, fetched along with the next chunk of the job.
+
+        Claims come in id order, so the items this node takes next are usually in the same chunk.
+        """
+        ids = msgid if isinstance(msgid, tuple) else (msgid,)
+        plan = self._queued_plans.get(job['_id'])
+        if plan and all(item_id in plan.messages for item_id in ids):
+            return plan
+        plan = await self.plan_job(message, job, [item_id for item_id in remaining_items(job) if item_id >= ids[0]][:PLAN_CHUNK])
+        if plan:
+            if len(self._queued_plans) >= 100:
+                self._queued_plans.clear()
+            self._queued_plans[job['_id']] = plan
+        return plan
+
+    async def finish_queued_item(self, queued: Dict):
+        """Close the job of a queued item once none of its items are left"""
+        counts = await self.queue.job_counts(queued['job_id'])
+        if counts.get('queued') or counts.get('leased'):
+            return
+        job = await self.jobs.get(queued['job_id'])
+        if job and job['status'] == RUNNING:
+            await self.close_job(job, counts.get('done', 0), counts.get('failed', 0))
 
     async def start(self):
+        started = time.monotonic()
         await self.initialize()
 
         @self.bot.on_message(filters.command(["start"]))
@@ -431,7 +936,7 @@ Simply share a post link, and I'll handle the rest.
             user_id = message.from_user.id
             
             # Check if user already has a session
-            if user_id in self.user_sessions:
+            if await self.has_session(user_id):
                 await self.bot.send_message(
                     message.chat.id,
                     "**You are already signed in!**\n"
@@ -449,6 +954,73 @@ Simply share a post link, and I'll handle the rest.
             )
             self.user_auth_states[user_id] = {"step": "phone"}
 
+        @self.bot.on_message(filters.command(["stats"]))
+        async def stats_command(client: Client, message: Message):
+            dedup = self.dedup.stats()
+            cached_settings = settings_cache.stats()
+            refs = file_refs.stats()
+            flights = in_flight.stats()
+            transfers = progress_bus.stats()
+            limits = self.rate_limiter.stats()
+            jobs = self.scheduler.stats()
+            ranged = ranged_downloader.stats()
+            pool_line = (
+                f"**Ranged downloads :** {ranged['downloads']} over {ranged['connections']} connections, "
+                f"{ranged['fallbacks']} CDN fallbacks"
+                + (f", last at {' / '.join(f'{s / (1024 * 1024):.1f}' for s in ranged['last_speeds'])}MB/s"
+                   if ranged['last_speeds'] else "")
+                + "\n"
+            )
+            if transfer_pool.running:
+                pool = transfer_pool.stats()
+                pool_line += (
+                    f"**Transfer processes :** {pool['processes']}  **Running :** {pool['running']}  "
+                    f"**Dispatched :** {pool['dispatched']}  **Restarts :** {pool['restarts']}\n"
+                )
+            sessions = self.session_stats
+            pooled = self.user_sessions.stats()
+            session_line = (
+                f"**Startup :** {self.startup_seconds:.1f}s  **Sessions :** {pooled['size']} started, "
+                f"avg start {sessions['start_seconds'] / max(sessions['started'], 1):.1f}s, {sessions['failed']} failed\n"
+                f"**Session pool :** {pooled['hits']} hits / {pooled['misses']} misses ({pooled['hit_rate']:.0%}), "
+                f"{pooled['evictions']} evicted, {pooled['restarts']} restarted, {pooled['busy']} busy\n"
+            )
+            if SESSION_WARMUP_LIMIT > 0:
+                session_line += f"**Warm-up :** {sessions['warmed']} sessions in {sessions['warmup_seconds']:.1f}s\n"
+            queue_line = ""
+            if self.queue:
+                queued = await self.queue.stats()
+                queue_line = f"**Queue :** {queued['queued']} queued, {queued['leased']} leased\n"
+                if self.worker:
+                    worker = self.worker.stats()
+                    queue_line += (
+                        f"**This worker :** {worker['running']} running, {worker['completed']} done, "
+                        f"{worker['released']} released, {worker['lost']} leases lost\n"
+                    )
+            await self.bot.send_message(
+                message.chat.id,
+                "**Bot Stats**\n\n"
+                f"**Dedup cache :** {dedup['hits']} hits / {dedup['misses']} misses "
+                f"({dedup['hit_rate']:.0%})\n"
+                f"**Evicted :** {dedup['evictions']}  **Invalidated :** {dedup['invalidations']}\n"
+                f"**Settings cache :** {cached_settings['hits']} hits / {cached_settings['misses']} reads "
+                f"({cached_settings['hit_rate']:.0%}), {cached_settings['invalidations']} invalidated\n"
+                f"**Thumbnails :** {refs['uploads']} uploaded, {refs['reused']} reused\n"
+                f"**Downloads in flight :** {flights['in_flight']}  **Coalesced :** {flights['coalesced']}\n"
+                f"**Active transfers :** {transfers['active']} at {transfers['speed'] / (1024 * 1024):.1f}MB/s\n"
+                f"**API calls :** {limits['calls']}  **Throttled :** {limits['throttled_seconds']:.0f}s  "
+                f"**FloodWaits :** {limits['flood_waits']}  **Paused chats :** {limits['paused_chats']}\n"
+                + session_line + pool_line + queue_line +
+                f"**Jobs :** {jobs['running']}/{jobs['slots']} running, {jobs['queued']} queued\n"
+                + "\n".join(
+                    f"  • `{name}` {lane['running']}/{lane['slots']} running, {lane['queued']} queued "
+                    f"from {lane['queued_users']} users (deepest {lane['max_user_depth']}), "
+                    f"wait avg {lane['avg_wait']:.1f}s p95 {lane['p95_wait']:.1f}s, aged {lane['aged']}"
+                    for name, lane in jobs['lanes'].items()
+                ),
+                reply_to_message_id=message.id
+            )
+
         @self.bot.on_message(filters.command(["cancel"]))
         async def cancel_user_task(client, message: Message):
             task_manager.cancel(message.from_user.id)
@@ -459,7 +1031,7 @@ Simply share a post link, and I'll handle the rest.
             user_id = message.from_user.id
             
             # Check if user already has a session
-            if user_id in self.user_sessions:
+            if await self.has_session(user_id):
                 await self.bot.send_message(
                     message.chat.id,
                     "**You are already signed in!**\n"
@@ -482,7 +1054,7 @@ Simply share a post link, and I'll handle the rest.
             user_id = message.from_user.id
             
             # Check if user already has a session
-            if user_id in self.user_sessions:
+            if await self.has_session(user_id):
                 await self.bot.send_message(
                     message.chat.id,
                     "**You are already signed in!**\n"
@@ -523,7 +1095,7 @@ Simply share a post link, and I'll handle the rest.
                 await self.save_session(user_id, session_string)
                 
                 # Store the session in memory cache
-                self.user_sessions[user_id] = user_client
+                await self.user_sessions.put(user_id, user_client)
                 
                 await self.bot.send_message(
                     message.chat.id,
@@ -624,7 +1196,7 @@ Simply share a post link, and I'll handle the rest.
                     await user_client.start()
                     
                     # Store the session in memory cache
-                    self.user_sessions[user_id] = user_client
+                    await self.user_sessions.put(user_id, user_client)
                     
                     # Clean up signin client
                     await auth_state["signin_client"].disconnect()
@@ -677,10 +1249,11 @@ Simply share a post link, and I'll handle the rest.
         async def logout_command(client: Client, message: Message):
             """Handle logout command"""
             user_id = message.from_user.id
-            if user_id in self.user_sessions:
+            if await self.has_session(user_id):
                 try:
-                    await self.user_sessions[user_id].stop()
-                    del self.user_sessions[user_id]
+                    user_client = self.user_sessions.pop(user_id)
+                    if user_client:
+                        await user_client.stop()
                     await self.delete_session(user_id)
                     await self.bot.send_message(
                         message.chat.id,
@@ -701,8 +1274,11 @@ Simply share a post link, and I'll handle the rest.
                     reply_to_message_id=message.id
                 )
 
-        logger.info("Bot started and running...")
+        self.startup_seconds = time.monotonic() - started
+        logger.info(f"Bot started and running in {self.startup_seconds:.1f}s...")
         await idle()
+        await transfer_pool.stop()
+        await self.user_sessions.stop()
 
 async def main():
     bot = TelegramBot()
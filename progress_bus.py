@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SPEED_WINDOW = 5.0  # Seconds of history the speed average mostly reflects
+
+class Transfer:
+    """Latest progress of one transfer plus a smoothed speed estimate"""
+    def __init__(self, key: str):
+        self.key = key
+        self.current = 0
+        self.total = 0
+        self.speed = 0.0  # bytes/s, exponential moving average
+        self.started_at = time.monotonic()
+        self.updated_at = self.started_at
+        self.closed = asyncio.Event()
+
+    @property
+    def percentage(self) -> float:
+        return self.current * 100 / self.total if self.total else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        if self.speed <= 0:
+            return None
+        return max(self.total - self.current, 0) / self.speed
+
+    def update(self, current: int, total: int):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        if elapsed > 0 and current >= self.current:
+            rate = (current - self.current) / elapsed
+            # Time-weighted so bursts of callbacks don't skew the average
+            alpha = 1 - math.exp(-elapsed / SPEED_WINDOW)
+            self.speed = rate if self.speed == 0 else self.speed + alpha * (rate - self.speed)
+        self.current = current
+        self.total = total
+        self.updated_at = now
+
+class ProgressBus:
+    """In-process hub where transfers publish byte counts and renderers read snapshots"""
+
+    def __init__(self):
+        self._transfers: Dict[str, Transfer] = {}
+        self._subscribers: List[Callable[[Transfer], None]] = []
+
+    def open(self, key: str) -> Transfer:
+        """Start tracking a transfer, reusing it if it already published"""
+        transfer = self._transfers.get(key)
+        if transfer is None:
+            transfer = self._transfers[key] = Transfer(key)
+        return transfer
+
+    def publish(self, key: str, current: int, total: int):
+        transfer = self.open(key)
+        transfer.update(current, total)
+        for callback in self._subscribers:
+            try:
+                callback(transfer)
+            except Exception as e:
+                logger.error(f"Progress subscriber failed: {e}")
+
+    def snapshot(self, key: str) -> Optional[Transfer]:
+        return self._transfers.get(key)
+
+    def close(self, key: str):
+        """Mark a transfer finished so its renderers stop"""
+        transfer = self._transfers.pop(key, None)
+        if transfer:
+            transfer.closed.set()
+
+    def subscribe(self, callback: Callable[[Transfer], None]):
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[Transfer], None]):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def stats(self) -> dict:
+        active = list(self._transfers.values())
+        return {
+            'active': len(active),
+            'speed': sum(t.speed for t in active)
+        }
+
+progress_bus = ProgressBus()
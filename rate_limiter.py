@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from pyrogram import Client, raw
+from pyrogram.errors import FloodWait
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import RATE_LIMIT_GLOBAL
+except ImportError:
+    RATE_LIMIT_GLOBAL = 30  # Outgoing messages per second across all chats
+
+try:
+    from config import RATE_LIMIT_PER_CHAT
+except ImportError:
+    RATE_LIMIT_PER_CHAT = 1  # Outgoing messages per second to a single chat
+
+try:
+    from config import RATE_LIMIT_BURST
+except ImportError:
+    RATE_LIMIT_BURST = 3  # Messages a quiet chat may receive back to back
+
+MAX_FLOOD_RETRIES = 5
+MAX_CHAT_BUCKETS = 10000  # Idle buckets are dropped beyond this
+
+# Calls Telegram counts against message flood limits
+LIMITED_QUERIES = (
+    raw.functions.messages.SendMessage,
+    raw.functions.messages.SendMedia,
+    raw.functions.messages.SendMultiMedia,
+    raw.functions.messages.EditMessage,
+    raw.functions.messages.ForwardMessages,
+    raw.functions.messages.UpdatePinnedMessage,
+)
+
+class TokenBucket:
+    """Token bucket that can be paused for the length of a FloodWait"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self) -> float:
+        """Take one token, returning how long we had to wait"""
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                delay = self.paused_until - now
+            else:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            await asyncio.sleep(delay)
+            waited += delay
+
+class RateLimiter:
+    """Shared budget for outgoing Telegram calls with per-chat buckets"""
+
+    def __init__(self, global_rate: float = RATE_LIMIT_GLOBAL, chat_rate: float = RATE_LIMIT_PER_CHAT,
+                 burst: float = RATE_LIMIT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.burst = burst
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.calls = 0
+        self.throttled_seconds = 0.0
+        self.flood_waits = 0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                self._prune()
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.burst)
+        return bucket
+
+    def _prune(self):
+        # A bucket that refilled completely carries no state worth keeping
+        now = time.monotonic()
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            idle_for = now - bucket.updated_at
+            if bucket.paused_until < now and bucket.tokens + idle_for * bucket.rate >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+
+    async def invoke(self, invoke, query, *args, **kwargs):
+        """Run a raw call within the budgets, absorbing FloodWait on the affected bucket"""
+        if not isinstance(query, LIMITED_QUERIES):
+            return await invoke(query, *args, **kwargs)
+
+        chat_id = peer_id(getattr(query, "to_peer", None) or getattr(query, "peer", None))
+        # FloodWait is handled here so it pauses the chat rather than sleeping inside pyrogram
+        kwargs.setdefault("sleep_threshold", 0)
+        bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+
+        for attempt in range(MAX_FLOOD_RETRIES + 1):
+            waited = 0.0
+            if bucket is not self.global_bucket:
+                waited += await bucket.acquire()
+            waited += await self.global_bucket.acquire()
+            self.throttled_seconds += waited
+            self.calls += 1
+
+            try:
+                return await invoke(query, *args, **kwargs)
+            except FloodWait as e:
+                if attempt == MAX_FLOOD_RETRIES:
+                    raise
+                self.flood_waits += 1
+                logger.warning(f"FloodWait of {e.value}s for chat {chat_id}, pausing its bucket")
+                bucket.pause(e.value)
+
+    def install(self, client: Client):
+        """Route every call made by `client` through this limiter"""
+        invoke = client.invoke
+
+        async def limited_invoke(query, *args, **kwargs):
+            return await self.invoke(invoke, query, *args, **kwargs)
+
+        client.invoke = limited_invoke
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            'calls': self.calls,
+            'throttled_seconds': self.throttled_seconds,
+            'flood_waits': self.flood_waits,
+            'paused_chats': sum(1 for b in self.chat_buckets.values() if b.paused_until > now)
+        }
+
+def peer_id(peer) -> Optional[int]:
+    """Chat id of a raw input peer, None when it can't be told"""
+    if isinstance(peer, raw.types.InputPeerUser):
+        return peer.user_id
+    if isinstance(peer, raw.types.InputPeerChat):
+        return -peer.chat_id
+    if isinstance(peer, raw.types.InputPeerChannel):
+        return int(f"-100{peer.channel_id}")
+    return None
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import SCHEDULER_LANES
+except ImportError:
+    # (name, largest job size in bytes, slots); the last lane takes everything bigger
+    SCHEDULER_LANES = [
+        ("small", 20 * 1024 * 1024, 4),
+        ("medium", 500 * 1024 * 1024, 4),
+        ("large", None, 2),
+    ]
+
+try:
+    from config import SCHEDULER_WEIGHTS_BY_TIER
+except ImportError:
+    SCHEDULER_WEIGHTS_BY_TIER = {}  # e.g. {"premium": 2}, users without a tier weigh 1
+
+try:
+    from config import SCHEDULER_AGING_SECONDS
+except ImportError:
+    SCHEDULER_AGING_SECONDS = 60  # A job waiting this long is served before smaller ones
+
+WAIT_SAMPLES = 500  # Recent waits kept for the stats
+
+def weight_for_tier(tier) -> float:
+    return SCHEDULER_WEIGHTS_BY_TIER.get(tier, 1) if tier else 1
+
+class _Ticket:
+    def __init__(self, user_id: int, size: int, cost: float, weight: float):
+        self.user_id = user_id
+        self.size = size
+        self.cost = cost
+        self.weight = weight
+        self.enqueued_at = time.monotonic()
+        self.granted = asyncio.get_running_loop().create_future()
+        self.lane: Optional["_Lane"] = None
+
+class _Lane:
+    """Slots for one size class, shared between users by deficit round-robin"""
+
+    def __init__(self, name: str, max_size: Optional[int], slots: int, shortest_first: bool, quantum: float):
+        self.name = name
+        self.max_size = max_size
+        self.slots = slots
+        self.shortest_first = shortest_first
+        self.quantum = quantum
+        self.running = 0
+        self.granted = 0
+        self.aged = 0
+        self._queues: Dict[int, Deque[_Ticket]] = {}
+        self._deficit: Dict[int, float] = {}
+        self._round: Deque[int] = deque()  # Users with waiting jobs, in service order
+        self._waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+
+    def enqueue(self, ticket: _Ticket):
+        queue = self._queues.get(ticket.user_id)
+        if queue is None:
+            queue = self._queues[ticket.user_id] = deque()
+            self._deficit[ticket.user_id] = 0.0
+            self._round.append(ticket.user_id)
+        queue.append(ticket)
+
+    def remove(self, ticket: _Ticket):
+        queue = self._queues.get(ticket.user_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                self._forget(ticket.user_id)
+
+    def _forget(self, user_id: int):
+        del self._queues[user_id]
+        del self._deficit[user_id]
+        self._round.remove(user_id)
+
+    def _pick(self, queue: Deque[_Ticket]) -> _Ticket:
+        """Next job of one user: smallest first, unless the oldest has waited too long"""
+        oldest = queue[0]  # Queues are kept in arrival order
+        if not self.shortest_first or len(queue) == 1:
+            return oldest
+        if time.monotonic() - oldest.enqueued_at >= SCHEDULER_AGING_SECONDS:
+            self.aged += 1
+            return oldest
+        return min(queue, key=lambda t: t.size)
+
+    def dispatch(self):
+        while self.running < self.slots and self._round:
+            user_id = self._round[0]
+            queue = self._queues[user_id]
+
+            # Drop waiters that were cancelled before they could clean up, wherever they queue
+            if any(t.granted.done() for t in queue):
+                queue = self._queues[user_id] = deque(t for t in queue if not t.granted.done())
+            if not queue:
+                self._forget(user_id)
+                continue
+
+            ticket = self._pick(queue)
+            if self._deficit[user_id] < ticket.cost:
+                # Out of credit this round, top up and move on to the next user
+                self._deficit[user_id] += self.quantum * ticket.weight
+                self._round.rotate(-1)
+                continue
+
+            self._deficit[user_id] -= ticket.cost
+            queue.remove(ticket)
+            if not queue:
+                self._forget(user_id)
+
+            if ticket.granted.done():
+                continue
+
+            self.running += 1
+            self.granted += 1
+            self._waits.append(time.monotonic() - ticket.enqueued_at)
+            ticket.granted.set_result(None)
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        depths = [len(queue) for queue in self._queues.values()]
+        return {
+            'slots': self.slots,
+            'running': self.running,
+            'queued': sum(depths),
+            'queued_users': len(depths),
+            'max_user_depth': max(depths, default=0),
+            'granted': self.granted,
+            'aged': self.aged,
+            'avg_wait': sum(waits) / len(waits) if waits else 0.0,
+            'p95_wait': waits[int(len(waits) * 0.95)] if waits else 0.0
+        }
+
+class JobScheduler:
+    """Process-wide job slots split into size lanes, each shared fairly between users"""
+
+    def __init__(self, lanes: List[tuple] = SCHEDULER_LANES, quantum: float = 1.0):
+        self.lanes = [
+            # Shortest-job-first everywhere but the catch-all lane of the biggest jobs
+            _Lane(name, max_size, slots, shortest_first=i < len(lanes) - 1, quantum=quantum)
+            for i, (name, max_size, slots) in enumerate(lanes)
+        ]
+
+    def lane_for(self, size: int) -> _Lane:
+        for lane in self.lanes:
+            if lane.max_size is None or size <= lane.max_size:
+                return lane
+        return self.lanes[-1]
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, size: int = 0, cost: float = 1, weight: float = 1):
+        """Hold one job slot for `user_id` in the lane matching `size` while the block runs"""
+        ticket = await self.acquire(user_id, size, cost, weight)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    async def acquire(self, user_id: int, size: int = 0, cost: float = 1, weight: float = 1) -> _Ticket:
+        ticket = _Ticket(user_id, size or 0, cost, weight)
+        ticket.lane = self.lane_for(ticket.size)
+        ticket.lane.enqueue(ticket)
+        ticket.lane.dispatch()
+
+        try:
+            await ticket.granted
+        except asyncio.CancelledError:
+            if ticket.granted.done() and not ticket.granted.cancelled():
+                self.release(ticket)
+            else:
+                ticket.lane.remove(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket: _Ticket):
+        ticket.lane.running -= 1
+        ticket.lane.dispatch()
+
+    def stats(self) -> dict:
+        lanes = {lane.name: lane.stats() for lane in self.lanes}
+        return {
+            'slots': sum(l['slots'] for l in lanes.values()),
+            'running': sum(l['running'] for l in lanes.values()),
+            'queued': sum(l['queued'] for l in lanes.values()),
+            'lanes': lanes
+        }
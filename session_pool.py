@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from pyrogram import Client
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import SESSION_POOL_SIZE
+except ImportError:
+    SESSION_POOL_SIZE = 100  # Started user clients kept connected, 0 keeps every one
+
+try:
+    from config import SESSION_IDLE_TIMEOUT
+except ImportError:
+    SESSION_IDLE_TIMEOUT = 1800  # Seconds an unused client stays connected, 0 keeps it until evicted for space
+
+class SessionPool:
+    """Started user clients, least recently used first.
+
+    Clients idle too long or pushed out by newer ones are stopped, unless a transfer holds them.
+    Evicted users start again on their next request.
+    """
+
+    def __init__(self, max_size: int = SESSION_POOL_SIZE, idle_timeout: float = SESSION_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._clients: "OrderedDict[int, Client]" = OrderedDict()
+        self._last_used: Dict[int, float] = {}
+        self._holds: Counter = Counter()  # user id -> transfers using the client
+        self._evicted = set()  # Users whose client was stopped by the pool
+        self._reaper: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.restarts = 0
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._clients
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def get(self, user_id: int) -> Optional[Client]:
+        """Started client of a user, marking it as just used"""
+        client = self._clients.get(user_id)
+        if client is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._clients.move_to_end(user_id)
+        self._last_used[user_id] = time.monotonic()
+        return client
+
+    async def put(self, user_id: int, client: Client):
+        """Add a started client, making room by stopping the least recently used idle ones"""
+        if user_id in self._evicted:
+            self._evicted.discard(user_id)
+            self.restarts += 1
+        self._clients[user_id] = client
+        self._clients.move_to_end(user_id)
+        self._last_used[user_id] = time.monotonic()
+        if self.max_size > 0:
+            while len(self._clients) > self.max_size:
+                victim = next((uid for uid in self._clients if not self._holds[uid] and uid != user_id), None)
+                if victim is None:
+                    break  # Everything else is mid-transfer, run over capacity until one finishes
+                await self._evict(victim)
+
+    def pop(self, user_id: int) -> Optional[Client]:
+        """Take a client out of the pool without stopping it"""
+        self._last_used.pop(user_id, None)
+        return self._clients.pop(user_id, None)
+
+    @asynccontextmanager
+    async def hold(self, user_id: int):
+        """Keep a user's client from being evicted while a transfer uses it"""
+        self._holds[user_id] += 1
+        try:
+            yield
+        finally:
+            self._holds[user_id] -= 1
+            if self._holds[user_id] <= 0:
+                del self._holds[user_id]
+            if user_id in self._clients:
+                self._last_used[user_id] = time.monotonic()
+
+    async def _evict(self, user_id: int):
+        client = self.pop(user_id)
+        if client is None:
+            return
+        self._evicted.add(user_id)
+        self.evictions += 1
+        try:
+            await client.stop()
+            logger.info(f"Stopped idle session of user {user_id}")
+        except Exception as e:
+            logger.error(f"Error stopping session of user {user_id}: {e}")
+
+    def start(self):
+        if self.idle_timeout > 0 and self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap())
+
+    async def stop(self):
+        """Stop the reaper and every pooled client"""
+        if self._reaper:
+            self._reaper.cancel()
+            self._reaper = None
+        for user_id in list(self._clients):
+            client = self.pop(user_id)
+            try:
+                await client.stop()
+            except Exception as e:
+                logger.error(f"Error stopping session of user {user_id}: {e}")
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout / 4, 60))
+            cutoff = time.monotonic() - self.idle_timeout
+            for user_id in [uid for uid, used in self._last_used.items() if used < cutoff]:
+                if not self._holds[user_id]:
+                    await self._evict(user_id)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._clients),
+            'max_size': self.max_size,
+            'busy': len(self._holds),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'restarts': self.restarts
+        }
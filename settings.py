@@ -1,7 +1,8 @@
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaPhoto
-from utils import process_thumbnail, get_user_thumbnail, get_destination_channel, set_destination_channel
-from utils import set_user_caption, get_user_caption
+from file_refs import file_refs
+from utils import process_thumbnail, get_user_thumbnail, set_destination_channel
+from utils import set_user_caption, set_replacement, clear_user_settings, clear_thumbnail, get_settings_snapshot
 import os
 
 class Settings:
@@ -9,19 +10,18 @@ class Settings:
         self.db = db
 
     async def get_user_settings(self, user_id: int) -> dict:
-        result = await self.db.users.find_one({'_id': user_id})
-        return result or {}
+        return await get_settings_snapshot(user_id, self.db)
 
     async def build_settings_text(self, user_id: int) -> tuple[str, InlineKeyboardMarkup]:
         """Build settings text and keyboard"""
         settings = await self.get_user_settings(user_id)
         
         # Check thumbnail
-        thumb_path = await get_user_thumbnail(user_id, self.db)
-        thumb_status = "✓ " if thumb_path else "X"
+        thumb_path = settings.get('thumb_path')
+        thumb_status = "✓ " if thumb_path and os.path.exists(thumb_path) else "X"
         
         # Check destination channel
-        dest_channel = await get_destination_channel(user_id, self.db)
+        dest_channel = settings.get('destination_channel')
         channel_status = f" {dest_channel}" if dest_channel else "X"
 
         # Get replacements
@@ -31,7 +31,7 @@ class Settings:
         )
         
         # Get caption
-        caption, use_filename = await get_user_caption(user_id, self.db)
+        caption, use_filename = settings.get('caption'), settings.get('caption_with_filename', False)
         caption_status = "X"
         if caption:
             caption_status = caption[:30] + ('...' if len(caption) > 30 else '')
@@ -65,18 +65,14 @@ class Settings:
         thumb_path = await get_user_thumbnail(user_id, self.db)
         settings_text, keyboard = await self.build_settings_text(user_id)
 
-        if thumb_path and os.path.exists(thumb_path):
-            await message.reply_photo(
-                photo=thumb_path,
-                caption=settings_text,
-                reply_markup=keyboard
-            )
-        else:
-            await message.reply_photo(
-                photo="thumbnail.jpg",
-                caption=settings_text,
-                reply_markup=keyboard
-            )
+        # Shown by file_id once Telegram has the image
+        photo = thumb_path if thumb_path and os.path.exists(thumb_path) else "thumbnail.jpg"
+        sent = await message.reply_photo(
+            photo=file_refs.photo(photo),
+            caption=settings_text,
+            reply_markup=keyboard
+        )
+        file_refs.remember_photo(photo, sent)
 
     async def handle_callback(self, client: Client, callback: CallbackQuery):
         data, user_id = callback.data.rsplit("_", 1)
@@ -89,36 +85,19 @@ class Settings:
         msg = callback.message
 
         if data == "clear_caption":
-            await self.db.users.update_one(
-                {'_id': user_id},
-                {'$unset': {'caption': 1, 'caption_with_filename': 1}}
-            )
+            await clear_user_settings(user_id, self.db, 'caption', 'caption_with_filename')
             await callback.answer("Caption cleared!")
 
         elif data == "clear_channel":
-            await self.db.users.update_one(
-                {'_id': user_id},
-                {'$unset': {'destination_channel': 1}}
-            )
+            await clear_user_settings(user_id, self.db, 'destination_channel')
             await callback.answer("Destination channel cleared!")
 
         elif data == "clear_rules":
-            await self.db.users.update_one(
-                {'_id': user_id},
-                {'$unset': {'replacements': 1}}
-            )
+            await clear_user_settings(user_id, self.db, 'replacements')
             await callback.answer("Filename rules cleared!")
 
         elif data == "clear_thumb":
-            result = await self.db.users.find_one({'_id': user_id})
-            if result and 'thumb_path' in result:
-                thumb_path = result['thumb_path']
-                if os.path.exists(thumb_path):
-                    os.remove(thumb_path)
-            await self.db.users.update_one(
-                {'_id': user_id},
-                {'$unset': {'thumb_path': 1}}
-            )
+            await clear_thumbnail(user_id, self.db)
             await callback.answer("Thumbnail cleared!")
 
         elif data == "close_settings":
@@ -129,17 +108,13 @@ class Settings:
         if data != "close_settings":
             settings_text, keyboard = await self.build_settings_text(user_id)
             thumb_path = await get_user_thumbnail(user_id, self.db)
+            photo = thumb_path if thumb_path and os.path.exists(thumb_path) else "thumbnail.jpg"
             
-            if thumb_path and os.path.exists(thumb_path):
-                await msg.edit_media(
-                    media=InputMediaPhoto(thumb_path, caption=settings_text),
-                    reply_markup=keyboard
-                )
-            else:
-                await msg.edit_media(
-                    media=InputMediaPhoto("thumbnail.jpg", caption=settings_text),
-                    reply_markup=keyboard
-                )
+            edited = await msg.edit_media(
+                media=InputMediaPhoto(file_refs.photo(photo), caption=settings_text),
+                reply_markup=keyboard
+            )
+            file_refs.remember_photo(photo, edited)
 
     async def set_thumbnail(self, client: Client, message: Message):
         replied = message.reply_to_message
@@ -148,7 +123,7 @@ class Settings:
 ** Set Custom Thumbnail ‼️**
 ```
 • Reply to a photo with /settb to set it as thumbnail
-• The image will be resized to 320x180
+• The image is cropped to fit videos (16:9), documents and audio covers (square)
 • The thumbnail will be used for all your uploads
 • Bot will use default thumbnail if none set
 ```
@@ -254,27 +229,19 @@ Send commands separately for multiple rules.
             rule = args[1].strip()
             user_id = message.from_user.id
             
-            # Get current replacements
-            settings = await self.get_user_settings(user_id)
-            replacements = settings.get('replacements', {})
-            
             if '-' in rule:
                 # Replace word case
                 old, new = rule.split('-', 1)
-                replacements[old.strip()] = new.strip()
+                pattern, replacement = old.strip(), new.strip()
             else:
                 # Remove word case
-                word = rule.strip()
-                replacements[word] = ''
+                pattern, replacement = rule.strip(), ''
             
             # Save to database
-            await self.db.users.update_one(
-                {'_id': user_id},
-                {'$set': {'replacements': replacements}},
-                upsert=True
-            )
-            
-            await message.reply_text("✅ Filename rule added successfully!")
+            if await set_replacement(user_id, pattern, replacement, self.db):
+                await message.reply_text("✅ Filename rule added successfully!")
+            else:
+                await message.reply_text("❌ Failed to save filename rule")
             
         except Exception as e:
             await message.reply_text(f"❌ Error: {str(e)}")
@@ -0,0 +1,82 @@
+import copy
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, TypedDict
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import SETTINGS_CACHE_SIZE
+except ImportError:
+    SETTINGS_CACHE_SIZE = 1000  # Users whose settings are kept in memory
+
+try:
+    from config import SETTINGS_CACHE_TTL
+except ImportError:
+    SETTINGS_CACHE_TTL = 300  # Seconds a cached snapshot is trusted, bounds staleness across nodes
+
+class UserSettings(TypedDict, total=False):
+    """User settings that change what a job produces"""
+    replacements: Dict[str, str]
+    caption: Optional[str]
+    caption_with_filename: bool
+    thumb_path: str
+    thumbs: Dict[str, str]  # Thumbnail variant -> path
+    thumb_hash: str
+    destination_channel: int
+    tier: str
+
+# Fields of the users collection a snapshot projects
+SETTINGS_FIELDS = tuple(UserSettings.__annotations__)
+
+class SettingsCache:
+    """Settings snapshots per user, least recently used dropped first.
+
+    Every write to the users collection must call `invalidate` for the user it changed.
+    """
+
+    def __init__(self, max_entries: int = SETTINGS_CACHE_SIZE, ttl: float = SETTINGS_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, Tuple[float, UserSettings]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._generation = 0  # Bumped by every invalidation
+
+    async def get(self, user_id: int, db) -> UserSettings:
+        """Copy of the user's settings, read from MongoDB only when not cached"""
+        entry = self._entries.get(user_id)
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            self.hits += 1
+            self._entries.move_to_end(user_id)
+            return copy.deepcopy(entry[1])
+
+        self.misses += 1
+        generation = self._generation
+        result = await db.users.find_one({'_id': user_id}, {field: 1 for field in SETTINGS_FIELDS})
+        settings: UserSettings = {field: result[field] for field in SETTINGS_FIELDS if field in result} if result else {}
+        if generation == self._generation:  # A write during the read may have made it stale
+            self._entries[user_id] = (time.monotonic(), settings)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return copy.deepcopy(settings)
+
+    def invalidate(self, user_id: int):
+        self._generation += 1
+        if self._entries.pop(user_id, None):
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'invalidations': self.invalidations
+        }
+
+settings_cache = SettingsCache()
@@ -0,0 +1,12 @@
+from filename_rules import compile_rules, sanitize
+
+def test_longer_pattern_wins_across_word_boundaries():
+    rules = compile_rules({'C': 'Cee', 'C++': 'Cpp'})
+    assert sanitize('C++ Primer.pdf', rules) == 'Cpp Primer.pdf'
+    assert sanitize('C Primer.pdf', rules) == 'Cee Primer.pdf'
+    assert sanitize('Cat.pdf', rules) == 'Cat.pdf'
+
+def test_rules_apply_in_one_pass():
+    rules = compile_rules({'part': 'chapter', 'chapter': 'section', '@[HD]': ''})
+    assert sanitize('Part 1 chapter [HD].mkv', rules) == 'chapter 1 section .mkv'
+    assert sanitize('parts.mkv', rules) == 'parts.mkv'
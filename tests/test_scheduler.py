@@ -0,0 +1,26 @@
+import asyncio
+
+from scheduler import JobScheduler
+
+def test_release_skips_job_cancelled_mid_queue():
+    async def scenario():
+        scheduler = JobScheduler(lanes=[("small", 100, 1), ("large", None, 1)])
+        lane = scheduler.lanes[0]
+        running = await scheduler.acquire(1, size=10)
+
+        big = asyncio.create_task(scheduler.acquire(1, size=50))
+        small = asyncio.create_task(scheduler.acquire(1, size=5))
+        await asyncio.sleep(0)
+        assert lane.stats()['queued'] == 2
+
+        # The cancelled ticket is still queued behind the bigger one when the slot frees up
+        small.cancel()
+        scheduler.release(running)
+
+        ticket = await asyncio.wait_for(big, 1)
+        assert lane.running == 1
+        assert lane.stats()['queued'] == 0
+        scheduler.release(ticket)
+        assert lane.running == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,67 @@
+import asyncio
+import hashlib
+import os
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+THUMB_DIR = "thumbs"
+os.makedirs(THUMB_DIR, exist_ok=True)
+
+# Telegram shows at most 320px a side and wants JPEGs under 200KB
+VARIANTS = {
+    "video": (320, 180),  # 16:9 frame
+    "document": (320, 320),  # Square tile
+    "audio": (320, 320)  # Square cover
+}
+JPEG_QUALITY = 87
+
+def variant_for(msg_type: str) -> str:
+    """Thumbnail variant matching how Telegram displays a media type"""
+    if msg_type in ("Video", "Animation"):
+        return "video"
+    if msg_type == "Audio":
+        return "audio"
+    return "document"
+
+def variant_path(digest: str, variant: str) -> str:
+    return os.path.join(THUMB_DIR, f"{digest[:32]}_{variant}.jpg")
+
+def _render(photo_path: str, digest: str) -> Dict[str, str]:
+    """Crop and resize the photo into every missing variant, runs off the event loop"""
+    paths = {variant: variant_path(digest, variant) for variant in VARIANTS}
+    missing = [variant for variant, path in paths.items() if not os.path.exists(path)]
+    if missing:
+        with Image.open(photo_path) as img:
+            img = ImageOps.exif_transpose(img).convert("RGB")
+            for variant in missing:
+                # Write aside first so a half written file is never picked up
+                tmp = f"{paths[variant]}.{os.getpid()}.tmp"
+                ImageOps.fit(img, VARIANTS[variant], Image.Resampling.LANCZOS).save(
+                    tmp, "JPEG", quality=JPEG_QUALITY, optimize=True
+                )
+                os.replace(tmp, paths[variant])
+    return paths
+
+def _digest(photo_path: str) -> str:
+    with open(photo_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+async def make_thumbnails(photo_path: str) -> Tuple[str, Dict[str, str]]:
+    """Content hash of a photo and its variant paths, rendered once per distinct image"""
+    loop = asyncio.get_running_loop()
+    digest = await loop.run_in_executor(None, _digest, photo_path)
+    paths = await loop.run_in_executor(None, _render, photo_path, digest)
+    return digest, paths
+
+def remove_thumbnails(digest: str):
+    for variant in VARIANTS:
+        try:
+            os.remove(variant_path(digest, variant))
+        except OSError:
+            pass
+
+def pick_thumbnail(settings: dict, msg_type: str) -> Optional[str]:
+    """Prepared thumbnail of the user for a media type, the single legacy one if that is all there is"""
+    thumb_path = (settings.get('thumbs') or {}).get(variant_for(msg_type)) or settings.get('thumb_path')
+    return thumb_path if thumb_path and os.path.exists(thumb_path) else None
@@ -0,0 +1,305 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import queue
+import time
+from typing import Callable, Dict, List, Optional
+
+from pyrogram import Client, raw
+from pyrogram.enums import ParseMode
+from pyrogram.parser.html import HTML
+
+from downloader import ranged_downloader, CdnRedirect
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import TRANSFER_PROCESSES
+except ImportError:
+    TRANSFER_PROCESSES = 0  # Worker processes doing downloads and uploads, 0 keeps them in the bot process
+
+MAX_USER_CLIENTS = 50  # User sessions a worker process keeps connected
+PROGRESS_INTERVAL = 0.5  # Seconds between progress reports sent back from a worker
+CHECK_INTERVAL = 1.0  # Seconds between checks that the workers are still alive
+
+class TransferError(Exception):
+    """A transfer failed inside a worker process"""
+
+class _Job:
+    def __init__(self, future: asyncio.Future, worker: "_Worker", progress: Optional[Callable], progress_args: tuple):
+        self.future = future
+        self.worker = worker
+        self.progress = progress
+        self.progress_args = progress_args
+
+class _Worker:
+    def __init__(self, index: int, process, requests):
+        self.index = index
+        self.process = process
+        self.requests = requests
+        self.jobs = set()  # Ids of the jobs it is running
+
+class TransferPool:
+    """Local worker processes with their own pyrogram clients, so MTProto crypto uses every core"""
+
+    def __init__(self, processes: int = TRANSFER_PROCESSES):
+        self.processes = processes
+        self.dispatched = 0
+        self.restarts = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: List[_Worker] = []
+        self._jobs: Dict[int, _Job] = {}
+        self._ids = itertools.count(1)
+        self._results = None
+        self._reader: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._reader is not None
+
+    def start(self):
+        if self.processes <= 0 or self.running:
+            return
+        self._results = self._context.Queue()
+        self._workers = [self._spawn(index) for index in range(self.processes)]
+        self._reader = asyncio.create_task(self._read_results())
+        logger.info(f"Started {self.processes} transfer processes")
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._reader.cancel()
+        self._reader = None
+        for worker in self._workers:
+            worker.requests.put(None)
+        for worker in self._workers:
+            await asyncio.get_running_loop().run_in_executor(None, worker.process.join, 10)
+        self._workers = []
+        for job in self._jobs.values():
+            if not job.future.done():
+                job.future.set_exception(TransferError("Transfer pool stopped"))
+        self._jobs.clear()
+
+    def _spawn(self, index: int) -> _Worker:
+        requests = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main, args=(index, self.processes, requests, self._results),
+            name=f"transfer-{index}", daemon=True
+        )
+        process.start()
+        return _Worker(index, process, requests)
+
+    async def download(self, acc: Client, media, file_name: str, progress: Optional[Callable] = None,
+                       progress_args: tuple = ()) -> str:
+        """Download `media` of a message fetched with `acc` in a worker process, returning the path"""
+        payload = {
+            'session': await acc.export_session_string(),
+            'file_id': media.file_id,
+            'file_size': media.file_size or 0,
+            'file_name': file_name
+        }
+        return await self._submit("download", payload, progress, progress_args)
+
+    async def upload(self, bot: Client, method: str, chat_id: int, file: str, progress: Optional[Callable] = None,
+                     progress_args: tuple = (), caption: Optional[str] = None, caption_entities=None, **kwargs):
+        """Send a local file with `method` (e.g. send_document) from a worker process, returning the Message"""
+        if caption and caption_entities:
+            # Entities hold a client reference and can't cross processes, HTML carries them instead
+            kwargs.update(caption=HTML.unparse(caption, caption_entities), parse_mode=ParseMode.HTML)
+        elif caption:
+            kwargs['caption'] = caption
+        payload = {
+            'method': method,
+            'chat_id': chat_id,
+            'peer': await _peer_row(bot, chat_id),
+            'file': file,
+            'kwargs': kwargs
+        }
+        msg_id = await self._submit("upload", payload, progress, progress_args)
+        return await bot.get_messages(chat_id, msg_id)
+
+    async def _submit(self, kind: str, payload: dict, progress: Optional[Callable], progress_args: tuple):
+        job_id = next(self._ids)
+        worker = min(self._workers, key=lambda w: len(w.jobs))
+        future = asyncio.get_running_loop().create_future()
+        self._jobs[job_id] = _Job(future, worker, progress, progress_args)
+        worker.jobs.add(job_id)
+        worker.requests.put((kind, job_id, payload))
+        self.dispatched += 1
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if job_id in self._jobs:
+                worker.requests.put(("cancel", job_id, None))
+            raise
+        finally:
+            self._finish(job_id)
+
+    def _finish(self, job_id: int):
+        job = self._jobs.pop(job_id, None)
+        if job:
+            job.worker.jobs.discard(job_id)
+
+    async def _read_results(self):
+        loop = asyncio.get_running_loop()
+        last_check = time.monotonic()
+        while True:
+            try:
+                event = await loop.run_in_executor(None, self._results.get, True, CHECK_INTERVAL)
+                await self._handle(event)
+            except queue.Empty:
+                pass
+            if time.monotonic() - last_check >= CHECK_INTERVAL:
+                last_check = time.monotonic()
+                self._check_workers()
+
+    async def _handle(self, event: tuple):
+        kind, job_id, *values = event
+        job = self._jobs.get(job_id)
+        if job is None or job.future.done():
+            return
+
+        if kind == "progress":
+            if job.progress:
+                try:
+                    await job.progress(*values, *job.progress_args)
+                except asyncio.CancelledError:
+                    # The owner gave up, stop the transfer in the worker too
+                    job.worker.requests.put(("cancel", job_id, None))
+                    job.future.cancel()
+                except Exception as e:
+                    logger.error(f"Progress callback failed: {e}")
+        elif kind == "done":
+            job.future.set_result(values[0])
+        elif kind == "cancelled":
+            job.future.cancel()
+        else:
+            job.future.set_exception(TransferError(values[0]))
+
+    def _check_workers(self):
+        for i, worker in enumerate(self._workers):
+            if worker.process.is_alive():
+                continue
+            logger.error(f"Transfer process {worker.index} died with code {worker.process.exitcode}, restarting it")
+            for job_id in list(worker.jobs):
+                job = self._jobs.get(job_id)
+                if job and not job.future.done():
+                    job.future.set_exception(TransferError("Transfer process died"))
+            self._workers[i] = self._spawn(worker.index)
+            self.restarts += 1
+
+    def stats(self) -> dict:
+        return {
+            'processes': len(self._workers),
+            'running': len(self._jobs),
+            'dispatched': self.dispatched,
+            'restarts': self.restarts
+        }
+
+async def _peer_row(client: Client, chat_id: int) -> tuple:
+    """Storage row of a chat, so a worker's empty session can reach it without resolving it again"""
+    peer = await client.resolve_peer(chat_id)
+    if isinstance(peer, raw.types.InputPeerChannel):
+        return (chat_id, peer.access_hash, "channel", None, None)
+    if isinstance(peer, raw.types.InputPeerUser):
+        return (chat_id, peer.access_hash, "user", None, None)
+    return (chat_id, 0, "group", None, None)
+
+def _worker_main(index: int, processes: int, requests, results):
+    """Entry point of a transfer process"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - transfer-{index} - %(name)s - %(levelname)s - %(message)s'
+    )
+    try:
+        asyncio.run(_serve(index, processes, requests, results))
+    except KeyboardInterrupt:
+        pass
+
+async def _serve(index: int, processes: int, requests, results):
+    from config import ID, HASH, TOKEN
+    from rate_limiter import RateLimiter, RATE_LIMIT_GLOBAL
+
+    bot = Client(f"transfer_{index}", api_id=ID, api_hash=HASH, bot_token=TOKEN, in_memory=True, no_updates=True)
+    # Every process gets its share of the bot's global message budget
+    RateLimiter(global_rate=RATE_LIMIT_GLOBAL / processes).install(bot)
+    await bot.start()
+
+    users: Dict[str, Client] = {}  # Session string -> started client, oldest first
+    tasks: Dict[int, asyncio.Task] = {}
+
+    async def user_client(session: str) -> Client:
+        client = users.pop(session, None)
+        if client is None:
+            if len(users) >= MAX_USER_CLIENTS:
+                oldest = next(iter(users))
+                await users.pop(oldest).stop()
+            client = Client(f"transfer_{index}_user", api_id=ID, api_hash=HASH, session_string=session,
+                            in_memory=True, no_updates=True)
+            await client.start()
+        users[session] = client
+        return client
+
+    async def run(kind: str, job_id: int, payload: dict):
+        last_report = 0.0
+        total_hint = payload.get('file_size', 0)
+
+        async def relay(current: int, total: int):
+            nonlocal last_report
+            now = time.monotonic()
+            total = total or total_hint
+            if now - last_report >= PROGRESS_INTERVAL or current >= total:
+                last_report = now
+                results.put(("progress", job_id, current, total))
+
+        try:
+            if kind == "download":
+                client = await user_client(payload['session'])
+                result = None
+                if ranged_downloader.wants(payload['file_size']):
+                    try:
+                        result = await ranged_downloader.download(
+                            client, payload['file_id'], payload['file_size'], payload['file_name'], progress=relay
+                        )
+                    except CdnRedirect:
+                        ranged_downloader.fallbacks += 1
+                if result is None:
+                    result = await client.download_media(payload['file_id'], file_name=payload['file_name'], progress=relay)
+            else:
+                await bot.storage.update_peers([payload['peer']])
+                msg = await getattr(bot, payload['method'])(
+                    payload['chat_id'], payload['file'], progress=relay, **payload['kwargs']
+                )
+                result = msg.id
+            results.put(("done", job_id, result))
+        except asyncio.CancelledError:
+            results.put(("cancelled", job_id))
+        except Exception as e:
+            logger.error(f"Transfer {job_id} failed: {e}")
+            results.put(("error", job_id, f"{type(e).__name__}: {e}"))
+        finally:
+            tasks.pop(job_id, None)
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            request = await loop.run_in_executor(None, requests.get)
+            if request is None:
+                break
+            kind, job_id, payload = request
+            if kind == "cancel":
+                task = tasks.get(job_id)
+                if task:
+                    task.cancel()
+                continue
+            tasks[job_id] = asyncio.create_task(run(kind, job_id, payload))
+    finally:
+        for task in list(tasks.values()):
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        for client in users.values():
+            await client.stop()
+        await bot.stop()
+
+transfer_pool = TransferPool()
@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import math
+import os
+from hashlib import md5
+from typing import AsyncIterator, Callable, Optional
+
+from pyrogram import Client, raw, types
+from pyrogram import utils as pyrogram_utils
+from pyrogram.session import Session
+
+from downloader import open_media_sessions
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import RELAY_BUFFER_CHUNKS
+except ImportError:
+    RELAY_BUFFER_CHUNKS = 8  # 1MB chunks held in memory between download and upload
+
+try:
+    from config import UPLOAD_CONNECTIONS
+except ImportError:
+    UPLOAD_CONNECTIONS = 4  # Media connections one file upload spreads its parts over
+
+try:
+    from config import UPLOAD_WINDOW
+except ImportError:
+    UPLOAD_WINDOW = 16  # Parts of one file in flight at the same time
+
+PART_SIZE = 512 * 1024  # Largest part size Telegram accepts
+BIG_FILE_SIZE = 10 * 1024 * 1024  # Files above this must use SaveBigFilePart
+MAX_UPLOAD_CONNECTIONS = 8
+MAX_PART_RETRIES = 3
+
+async def buffered(chunks: AsyncIterator[bytes], maxsize: int = RELAY_BUFFER_CHUNKS) -> AsyncIterator[bytes]:
+    """Read `chunks` ahead into a bounded queue so download and upload overlap"""
+    queue = asyncio.Queue(maxsize)
+    done = object()
+
+    async def reader():
+        try:
+            async for chunk in chunks:
+                await queue.put(chunk)
+            await queue.put(done)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+
+    task = asyncio.create_task(reader())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+
+async def upload_stream(
+    client: Client,
+    chunks: AsyncIterator[bytes],
+    file_size: int,
+    file_name: str,
+    progress: Optional[Callable] = None,
+    progress_args: tuple = ()
+) -> "raw.base.InputFile":
+    """Upload a byte stream of known size as file parts and return its InputFile"""
+    if file_size <= 0:
+        raise ValueError("File size must be known to stream an upload")
+
+    is_big = file_size > BIG_FILE_SIZE
+    total_parts = math.ceil(file_size / PART_SIZE)
+    file_id = client.rnd_id()
+    md5_sum = None if is_big else md5()
+
+    buffer = bytearray()
+    part = 0
+    uploaded = 0
+
+    async def save_part(data: bytes):
+        nonlocal part, uploaded
+        if is_big:
+            rpc = raw.functions.upload.SaveBigFilePart(
+                file_id=file_id, file_part=part,
+                file_total_parts=total_parts, bytes=data
+            )
+        else:
+            rpc = raw.functions.upload.SaveFilePart(file_id=file_id, file_part=part, bytes=data)
+            md5_sum.update(data)
+
+        if not await client.invoke(rpc):
+            raise IOError(f"Telegram rejected part {part} of {file_name}")
+
+        part += 1
+        uploaded += len(data)
+        if progress:
+            await progress(uploaded, file_size, *progress_args)
+
+    async for chunk in buffered(chunks):
+        buffer.extend(chunk)
+        while len(buffer) >= PART_SIZE:
+            await save_part(bytes(buffer[:PART_SIZE]))
+            del buffer[:PART_SIZE]
+
+    if buffer:
+        await save_part(bytes(buffer))
+
+    if part != total_parts:
+        raise IOError(f"Stream ended after {uploaded} of {file_size} bytes")
+
+    if is_big:
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=file_name)
+    return raw.types.InputFile(id=file_id, parts=total_parts, name=file_name, md5_checksum=md5_sum.hexdigest())
+
+def _save_part_rpc(file_id: int, part: int, total_parts: int, data: bytes, is_big: bool):
+    if is_big:
+        return raw.functions.upload.SaveBigFilePart(
+            file_id=file_id, file_part=part, file_total_parts=total_parts, bytes=data
+        )
+    return raw.functions.upload.SaveFilePart(file_id=file_id, file_part=part, bytes=data)
+
+async def upload_file(
+    client: Client,
+    path: str,
+    progress: Optional[Callable] = None,
+    progress_args: tuple = (),
+    connections: int = UPLOAD_CONNECTIONS,
+    window: int = UPLOAD_WINDOW
+) -> "raw.base.InputFile":
+    """Upload a local file with up to `window` parts in flight over several connections.
+
+    Failed parts are retried on their own. Progress counts acknowledged bytes.
+    """
+    file_size = os.path.getsize(path)
+    if file_size == 0:
+        raise ValueError("File size equals to 0 B")
+
+    is_big = file_size > BIG_FILE_SIZE
+    total_parts = math.ceil(file_size / PART_SIZE)
+    file_id = client.rnd_id()
+    file_name = os.path.basename(path)
+    md5_sum = None if is_big else md5()
+    connections = max(1, min(connections, MAX_UPLOAD_CONNECTIONS, total_parts))
+
+    slots = asyncio.Semaphore(max(1, window))
+    pending = set()
+    failure: Optional[BaseException] = None
+    uploaded = 0
+
+    async def send(sessions: list, part: int, data: bytes):
+        nonlocal uploaded, failure
+        try:
+            rpc = _save_part_rpc(file_id, part, total_parts, data, is_big)
+            for attempt in range(MAX_PART_RETRIES):
+                # A retry goes out on another connection in case this one is the problem
+                session: Session = sessions[(part + attempt) % len(sessions)]
+                try:
+                    if await session.invoke(rpc, sleep_threshold=30):
+                        break
+                    error = IOError(f"Telegram rejected part {part} of {file_name}")
+                except (OSError, asyncio.TimeoutError) as e:
+                    error = e
+                if attempt == MAX_PART_RETRIES - 1:
+                    raise error
+                logger.warning(f"Retrying part {part} of {file_name}: {error}")
+                await asyncio.sleep(1)
+
+            uploaded += len(data)
+            if progress:
+                await progress(min(uploaded, file_size), file_size, *progress_args)
+        except BaseException as e:
+            failure = failure or e
+        finally:
+            slots.release()
+
+    sessions = await open_media_sessions(client, await client.storage.dc_id(), connections)
+    try:
+        with open(path, "rb") as f:
+            for part in range(total_parts):
+                await slots.acquire()
+                if failure:
+                    break
+                data = os.pread(f.fileno(), PART_SIZE, part * PART_SIZE)
+                if md5_sum:
+                    md5_sum.update(data)
+                task = asyncio.create_task(send(sessions, part, data))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        await asyncio.gather(*pending)
+        if failure:
+            raise failure
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for session in sessions:
+            await session.stop()
+
+    if is_big:
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=file_name)
+    return raw.types.InputFile(id=file_id, parts=total_parts, name=file_name, md5_checksum=md5_sum.hexdigest())
+
+async def upload_missing_part(client: Client, path: str, uploaded: "raw.base.InputFile", part: int):
+    """Upload one part of a file again after Telegram reported it missing"""
+    with open(path, "rb") as f:
+        data = os.pread(f.fileno(), PART_SIZE, part * PART_SIZE)
+    is_big = isinstance(uploaded, raw.types.InputFileBig)
+    await client.invoke(_save_part_rpc(uploaded.id, part, uploaded.parts, data, is_big))
+
+async def send_uploaded_media(
+    client: Client,
+    chat_id: int,
+    media: "raw.base.InputMedia",
+    caption: Optional[str] = None,
+    caption_entities: Optional[list] = None
+) -> Optional["types.Message"]:
+    """Send already uploaded media and return the parsed message"""
+    r = await client.invoke(
+        raw.functions.messages.SendMedia(
+            peer=await client.resolve_peer(chat_id),
+            media=media,
+            random_id=client.rnd_id(),
+            **await pyrogram_utils.parse_text_entities(client, caption or "", None, caption_entities)
+        )
+    )
+
+    for i in r.updates:
+        if isinstance(i, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await types.Message._parse(
+                client, i.message,
+                {u.id: u for u in r.users},
+                {c.id: c for c in r.chats}
+            )
+    return None
@@ -1,47 +1,77 @@
 import os
 import asyncio
 import logging
-import glob
 
-import re
-from typing import Optional
-from pyrogram import Client
-from pyrogram.types import Message
+from contextlib import aclosing
+from typing import List, Optional
+from pyrogram import Client, raw
+from pyrogram.errors import FilePartMissing
+from pyrogram.types import Message, InputMediaPhoto, InputMediaVideo, InputMediaAudio, InputMediaDocument
 from config import DUMP_CHANNEL_ID
-from PIL import Image
 from task_manager import task_manager
-from video_handler import split_video, cleanup_split_files
+from video_handler import iter_split_video, cleanup_split_files, probe
+from uploader import upload_stream, upload_file, upload_missing_part, send_uploaded_media, BIG_FILE_SIZE
+from dedup_cache import make_key
+from inflight import in_flight
+from progress_bus import progress_bus, Transfer
+from transfer_pool import transfer_pool
+from downloader import ranged_downloader
+from settings_cache import settings_cache, UserSettings
+from filename_rules import compile_rules, rule_cache, sanitize
+from thumbnails import THUMB_DIR, make_thumbnails, remove_thumbnails, pick_thumbnail
+from file_refs import file_refs
+
+try:
+    from config import STREAM_RELAY
+except ImportError:
+    STREAM_RELAY = False  # Stream eligible media from the user session straight into the bot upload
+
+STATUS_INTERVAL = 5  # Seconds between status message edits
+DEFAULT_VIDEO_SIZE = (320, 180)  # Announced when neither the file nor the source message knows it
 
 # Remove MongoDB imports and initialization since it's in main.py
 logger = logging.getLogger(__name__)
 
-THUMB_DIR = "thumbs"
-os.makedirs(THUMB_DIR, exist_ok=True)
-
 async def process_thumbnail(user_id: int, photo_path: str, db) -> Optional[str]:
-    """Process and save user thumbnail"""
+    """Prepare the user's thumbnail for every media type and save it"""
     try:
-        thumb_path = os.path.join(THUMB_DIR, f"{user_id}_thumb.jpg")
-        with Image.open(photo_path) as img:
-            img.resize((320, 180), Image.Resampling.LANCZOS).save(thumb_path, "JPEG")
+        previous = await get_settings_snapshot(user_id, db)
+        digest, thumbs = await make_thumbnails(photo_path)
         # Store path in MongoDB using passed db instance
         await db.users.update_one(
             {'_id': user_id},
-            {'$set': {'thumb_path': thumb_path}},
+            {'$set': {'thumb_path': thumbs['video'], 'thumbs': thumbs, 'thumb_hash': digest}},
             upsert=True
         )
-        return thumb_path
+        settings_cache.invalidate(user_id)
+        if previous.get('thumb_hash') != digest:
+            await _release_thumbnail(previous, db)
+        return thumbs['video']
     except Exception as e:
         logger.error(f"Error processing thumbnail: {e}")
         return None
 
+async def clear_thumbnail(user_id: int, db):
+    """Remove the user's thumbnail"""
+    previous = await get_settings_snapshot(user_id, db)
+    await clear_user_settings(user_id, db, 'thumb_path', 'thumbs', 'thumb_hash')
+    await _release_thumbnail(previous, db)
+
+async def _release_thumbnail(settings: dict, db):
+    """Delete thumbnail files no other user shares"""
+    for path in {settings.get('thumb_path'), *(settings.get('thumbs') or {}).values()} - {None}:
+        file_refs.forget(path)
+    digest = settings.get('thumb_hash')
+    if digest:
+        if not await db.users.find_one({'thumb_hash': digest}, {'_id': 1}):
+            remove_thumbnails(digest)
+    elif settings.get('thumb_path') and os.path.exists(settings['thumb_path']):
+        os.remove(settings['thumb_path'])  # Single thumbnail from before variants
+
 async def get_user_thumbnail(user_id: int, db) -> Optional[str]:
     """Get user's thumbnail path from MongoDB"""
-    result = await db.users.find_one({'_id': user_id})
-    if result and 'thumb_path' in result:
-        thumb_path = result['thumb_path']
-        return thumb_path if os.path.exists(thumb_path) else None
-    return None
+    thumb_path = (await get_settings_snapshot(user_id, db)).get('thumb_path')
+    return thumb_path if thumb_path and os.path.exists(thumb_path) else None
 
 async def set_destination_channel(user_id: int, channel_id: int, db) -> bool:
     """Save user's destination channel ID to MongoDB"""
@@ -51,6 +81,7 @@ async def set_destination_channel(user_id: int, channel_id: int, db) -> bool:
             {'$set': {'destination_channel': channel_id}},
             upsert=True
         )
+        settings_cache.invalidate(user_id)
         return True
     except Exception as e:
         logger.error(f"Error saving destination channel: {e}")
@@ -58,98 +89,64 @@ async def set_destination_channel(user_id: int, channel_id: int, db) -> bool:
 
 async def get_destination_channel(user_id: int, db) -> Optional[int]:
     """Get user's destination channel from MongoDB"""
-    result = await db.users.find_one({'_id': user_id})
-    return result.get('destination_channel') if result else None
+    return (await get_settings_snapshot(user_id, db)).get('destination_channel')
 
-async def cleanup_old_status_files():
-    try:
-        for file in glob.glob("*status.txt"):
-            os.remove(file)
-    except Exception as e:
-        logger.error(f"Error cleaning up status files: {e}")
+async def downstatus(transfer: Transfer, message: Message, bot: Client, filename: str):
+    await render_status(transfer, message, bot, filename, "📥 **Downloading**")
 
-async def downstatus(statusfile: str, message: Message, bot: Client, filename: str):
-    while not os.path.exists(statusfile):
-        await asyncio.sleep(3)
+async def upstatus(transfer: Transfer, message: Message, bot: Client, filename: str):
+    await render_status(transfer, message, bot, filename, "📤 **Uploading**")
 
-    while os.path.exists(statusfile):
-        user_id = message.from_user.id if message.from_user else message.chat.id
-        if task_manager.is_cancelled(user_id):
+async def render_status(transfer: Transfer, message: Message, bot: Client, filename: str, title: str):
+    """Edit the status message from the transfer's latest snapshot until it closes"""
+    user_id = message.from_user.id if message.from_user else message.chat.id
+    last_current = None
 
-            break
+    while not transfer.closed.is_set():
         try:
-            with open(statusfile, "r") as f:
-                data = f.read().split("|")
-                if len(data) == 3:
-                    percentage, current, total = data
-                    cur_mb = int(current) / (1024 * 1024)
-                    total_mb = int(total) / (1024 * 1024)
-                    speed = cur_mb / 5
-
-                    progress_bar = create_progress_bar(float(percentage))
-                    text = (
-                        f"📥 **Downloading**\n\n`{filename}`\n\n"
-                        f"```\n{progress_bar}\nProgress: {percentage}%\n"
-                        f"Size: {cur_mb:.1f}MB / {total_mb:.1f}MB\n"
-                        f"Speed: {speed:.1f}MB/s\n"
-                        
-                        f"ETA: {((total_mb - cur_mb) / speed):.1f}s\n```"
-                        f"Cancel this task using /cancel\n"
-                    )
-                    await bot.edit_message_text(message.chat.id, message.id, text)
-            await asyncio.sleep(5)
-        except Exception as e:
-            logger.error(f"Error in download status: {e}")
-            await asyncio.sleep(5)
-
-async def upstatus(statusfile: str, message: Message, bot: Client, filename: str):
-    while not os.path.exists(statusfile):
-        await asyncio.sleep(3)
+            await asyncio.wait_for(transfer.closed.wait(), STATUS_INTERVAL)
+            break
+        except asyncio.TimeoutError:
+            pass
 
-    while os.path.exists(statusfile):
-        user_id = message.from_user.id if message.from_user else message.chat.id
         if task_manager.is_cancelled(user_id):
-
             break
+        if not transfer.total or transfer.current == last_current:
+            continue
+        last_current = transfer.current
+
         try:
-            with open(statusfile, "r") as f:
-                data = f.read().split("|")
-                if len(data) == 3:
-                    percentage, current, total = data
-                    cur_mb = int(current) / (1024 * 1024)
-                    total_mb = int(total) / (1024 * 1024)
-                    speed = cur_mb / 5
-
-                    progress_bar = create_progress_bar(float(percentage))
-                    text = (
-                        f"📤 **Uploading**\n\n`{filename}`\n\n"
-                        f"```\n{progress_bar}\nProgress: {percentage}%\n"
-                        f"Size: {cur_mb:.1f}MB / {total_mb:.1f}MB\n"
-                        f"Speed: {speed:.1f}MB/s\n"
-                        f"ETA: {((total_mb - cur_mb) / speed):.1f}s\n```"
-                        f"Cancel this task using  /cancel\n"
-                    )
-                    await bot.edit_message_text(message.chat.id, message.id, text)
-            await asyncio.sleep(5)
+            cur_mb = transfer.current / (1024 * 1024)
+            total_mb = transfer.total / (1024 * 1024)
+            eta = transfer.eta
+            progress_bar = create_progress_bar(transfer.percentage)
+            text = (
+                f"{title}\n\n`{filename}`\n\n"
+                f"```\n{progress_bar}\nProgress: {transfer.percentage:.1f}%\n"
+                f"Size: {cur_mb:.1f}MB / {total_mb:.1f}MB\n"
+                f"Speed: {transfer.speed / (1024 * 1024):.1f}MB/s\n"
+                f"ETA: {f'{eta:.0f}s' if eta is not None else '-'}\n```"
+                f"Cancel this task using /cancel\n"
+            )
+            await bot.edit_message_text(message.chat.id, message.id, text)
         except Exception as e:
-            logger.error(f"Error in upload status: {e}")
-            await asyncio.sleep(5)
+            logger.error(f"Error in status update: {e}")
 
 def create_progress_bar(percentage: float) -> str:
     filled = int(20 * (percentage / 100))
     bar = '▰' * filled + '▱' * (20 - filled)
     return f"`[{bar}]`"
 
-async def progress(current: int, total: int, message: Message, type: str):
-    percentage = (current * 100) / total
+def progress_key(message: Message, type: str) -> str:
+    """Progress bus key of one transfer belonging to a user request"""
+    return f"{message.chat.id}:{message.id}{type}"
 
+async def progress(current: int, total: int, message: Message, type: str):
     # Cancel if user requested
     if task_manager.is_cancelled(message.from_user.id):
         raise asyncio.CancelledError("Upload cancelled by user.")
 
-    async with asyncio.Lock():
-        with open(f'{message.id}{type}status.txt', "w") as f:
-            f.write(f"{percentage:.1f}|{current}|{total}")
+    progress_bus.publish(progress_key(message, type), current, total)
 
 def get_message_type(msg: Message) -> str:
     try:
@@ -178,30 +175,14 @@ def get_message_type(msg: Message) -> str:
     except: pass
     return "Unknown"
 
-async def cleanup_files(message_id: int):
-    for file in [f"{message_id}downstatus.txt", f"{message_id}upstatus.txt"]:
-        if os.path.exists(file):
-            os.remove(file)
-
 async def get_user_replacements(user_id: int, db) -> dict:
     """Get user's filename replacement rules"""
-    result = await db.users.find_one({'_id': user_id})
-    return result.get('replacements', {}) if result else {}
-
-def sanitize_filename(name: str, user_replacements: dict = None) -> str:
-    """Sanitize filename using user-specific replacement rules"""
-    if user_replacements:
-        for pattern, replacement in user_replacements.items():
-            if pattern.startswith('@') or not replacement:
-                # Remove pattern completely
-                name = re.sub(rf'\b{pattern[1:] if pattern.startswith("@") else pattern}\b', '', name, flags=re.IGNORECASE)
-            else:
-                # Replace with specified text
-                name = re.sub(rf'\b{pattern}\b', replacement, name, flags=re.IGNORECASE)
-    
-    # Remove any remaining unsafe characters
-    name = re.sub(r'[<>:"/\\|?*]', '', name)
-    return name.strip()
+    return (await get_settings_snapshot(user_id, db)).get('replacements', {})
+
+def sanitize_filename(name: str, user_replacements: dict = None, user_id: Optional[int] = None) -> str:
+    """Sanitize filename using user-specific replacement rules, compiled once per user"""
+    rules = rule_cache.get(user_id, user_replacements) if user_id is not None else compile_rules(user_replacements)
+    return sanitize(name, rules)
 
 async def set_user_caption(user_id: int, caption: str, use_filename: bool, db) -> bool:
     """Save user's custom caption to MongoDB"""
@@ -214,217 +195,590 @@ async def set_user_caption(user_id: int, caption: str, use_filename: bool, db) -
             }},
             upsert=True
         )
+        settings_cache.invalidate(user_id)
         return True
     except Exception as e:
         logger.error(f"Error saving caption: {e}")
         return False
 
+async def set_replacement(user_id: int, pattern: str, replacement: str, db) -> bool:
+    """Add or change one of the user's filename rules, an empty replacement removes the pattern"""
+    try:
+        # Patterns may hold dots, which a field path would read as nesting, so the whole dict is written.
+        # It is read fresh, a cached snapshot could miss rules another node just saved
+        user = await db.users.find_one({'_id': user_id}, {'replacements': 1})
+        replacements = (user or {}).get('replacements') or {}
+        replacements[pattern] = replacement
+        await db.users.update_one(
+            {'_id': user_id},
+            {'$set': {'replacements': replacements}},
+            upsert=True
+        )
+        settings_cache.invalidate(user_id)
+        rule_cache.invalidate(user_id)
+        return True
+    except Exception as e:
+        logger.error(f"Error saving filename rule: {e}")
+        return False
+
+async def clear_user_settings(user_id: int, db, *fields: str):
+    """Remove some of the user's settings"""
+    await db.users.update_one({'_id': user_id}, {'$unset': {field: 1 for field in fields}})
+    settings_cache.invalidate(user_id)
+    if 'replacements' in fields:
+        rule_cache.invalidate(user_id)
+
+async def get_settings_snapshot(user_id: int, db) -> UserSettings:
+    """Copy of the user's output settings, pinned by batches for their whole run"""
+    return await settings_cache.get(user_id, db)
+
 async def get_user_caption(user_id: int, db) -> tuple[Optional[str], bool]:
     """Get user's custom caption and filename flag from MongoDB"""
-    result = await db.users.find_one({'_id': user_id})
-    if result:
-        return result.get('caption'), result.get('caption_with_filename', False)
-    return None, False
+    settings = await get_settings_snapshot(user_id, db)
+    return settings.get('caption'), settings.get('caption_with_filename', False)
+
+def remove_job_file(path: str):
+    """Remove a job's media file and its private folder once empty"""
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+class PreparedMedia:
+    """Downloaded media waiting to be uploaded (file is None when it will be relayed)"""
+    def __init__(self, file: Optional[str], filename: str, status_msg: Message, suffix: str = "",
+                 cache_key: Optional[str] = None, dump_msg_id: Optional[int] = None):
+        self.file = file
+        self.filename = filename
+        self.status_msg = status_msg
+        self.suffix = suffix
+        self.cache_key = cache_key
+        self.dump_msg_id = dump_msg_id  # Set when the dedup cache already holds this output
 
 class MediaHandler:
-    def __init__(self, bot: Client, acc: Optional[Client] = None, db=None):
+    def __init__(self, bot: Client, acc: Optional[Client] = None, db=None, dedup=None, settings: Optional[dict] = None):
         self.bot = bot
         self.acc = acc
         self.db = db  # Add db instance
-        self.semaphore = asyncio.Semaphore(5)
+        self.dedup = dedup
+        self.settings = settings  # Snapshot from get_settings_snapshot, loaded on first use when None
         self.dump_channel_id = DUMP_CHANNEL_ID
         self.rename_folder = "rename"
         os.makedirs(self.rename_folder, exist_ok=True)
         self.thumb_dir = THUMB_DIR
 
+    async def _user_settings(self, user_id: int) -> dict:
+        if self.settings is None:
+            self.settings = await get_settings_snapshot(user_id, self.db)
+        return self.settings
+
+    async def _user_thumbnail(self, user_id: int, msg_type: str = "Document") -> Optional[str]:
+        """The user's thumbnail prepared for `msg_type`"""
+        return pick_thumbnail(await self._user_settings(user_id), msg_type)
+
     async def handle_media(self, message: Message, msg: Message, msg_type: str):
-        async with self.semaphore:
-            # Get user replacements
-            user_replacements = await get_user_replacements(message.from_user.id, self.db)
-            
-            filename = getattr(msg, msg_type.lower(), None)
-            filename = getattr(filename, "file_name", "Unknown") if filename else "Unknown"
-            filename = sanitize_filename(filename, user_replacements)
+        prepared = await self.prefetch_media(message, msg, msg_type)
+        if prepared:
+            await self.deliver_media(message, msg, msg_type, prepared)
 
-            smsg = await self.bot.send_message(message.chat.id, f"📥 **Downloading**\n`{filename}`", reply_to_message_id=message.id)
-            down_task = asyncio.create_task(downstatus(f"{message.id}downstatus.txt", smsg, self.bot, filename))
+    async def prefetch_media(self, message: Message, msg: Message, msg_type: str, album: bool = False) -> Optional[PreparedMedia]:
+        """Download and rename media so it is ready for upload, always to disk for album members"""
+        # Get user replacements
+        user_replacements = (await self._user_settings(message.from_user.id)).get('replacements', {})
 
-            file = None
-            try:
-                if task_manager.is_cancelled(message.from_user.id):
-                    raise asyncio.CancelledError("Download cancelled.")
+        filename = getattr(msg, msg_type.lower(), None)
+        filename = getattr(filename, "file_name", "Unknown") if filename else "Unknown"
+        filename = sanitize_filename(filename, user_replacements, message.from_user.id)
 
-                file = await self.acc.download_media(
-                    msg,
-                    progress=progress,
-                    progress_args=[message, "down"]
-                )
+        # Prefetched items of one batch download side by side, so key status files per item
+        suffix = str(msg.id)
+        smsg = await self.bot.send_message(message.chat.id, f"📥 **Downloading**\n`{filename}`", reply_to_message_id=message.id)
 
-                if task_manager.is_cancelled(message.from_user.id):
-                    raise asyncio.CancelledError("Download cancelled after complete.")
+        file = None
+        try:
+            # Albums are sent as a whole, so their members are neither cached nor relayed alone
+            cache_key = None if album else await self._dedup_key(message, msg, msg_type, user_replacements)
+            if cache_key:
+                dump_msg_id = await self.dedup.get(cache_key)
+                if dump_msg_id:
+                    return PreparedMedia(None, filename, smsg, suffix, cache_key, dump_msg_id)
+
+            if not album and self._can_relay(msg, msg_type):
+                # Nothing to fetch ahead, the bytes are streamed during delivery
+                return PreparedMedia(None, filename, smsg, suffix, cache_key)
+
+            file = await self._download_media(message, msg, msg_type, filename, suffix, smsg)
+            return PreparedMedia(file, filename, smsg, suffix, cache_key)
+
+        except asyncio.CancelledError:
+            # Raised by our own checks when the user cancels, otherwise the task itself is being cancelled
+            by_user = task_manager.is_cancelled(message.from_user.id)
+            task_manager.clear(message.from_user.id)
+            progress_bus.close(progress_key(message, f"down{suffix}"))
+            if file: remove_job_file(file)
+            await smsg.edit_text("❌ Task cancelled.")
+            if not by_user:
+                raise
+            return None
 
-                await cleanup_files(message.id)
+        except Exception as e:
+            logger.error(f"MediaHandler error: {e}")
+            await self.bot.send_message(message.chat.id, f"**Error**: {e}", reply_to_message_id=message.id)
 
-                # Rename
-                if os.path.exists(file):
-                    ext = os.path.splitext(file)[1]
-                    new_file = os.path.join(self.rename_folder, f"{filename}{ext}")
-                    os.rename(file, new_file)
-                    file = new_file
+        progress_bus.close(progress_key(message, f"down{suffix}"))
+        await self.bot.delete_messages(message.chat.id, [smsg.id])
+        if file: remove_job_file(file)
+        return None
 
-                await smsg.edit_text(f"📤 **Uploading**\n`{filename}`")
-                up_task = asyncio.create_task(upstatus(f"{message.id}upstatus.txt", smsg, self.bot, filename))
+    async def _download_media(self, message: Message, msg: Message, msg_type: str, filename: str, suffix: str, smsg: Message) -> str:
+        """Download media with the user session into a private job folder and rename it"""
+        transfer = progress_bus.open(progress_key(message, f"down{suffix}"))
+        down_task = asyncio.create_task(downstatus(transfer, smsg, self.bot, filename))
+
+        if task_manager.is_cancelled(message.from_user.id):
+            raise asyncio.CancelledError("Download cancelled.")
+
+        # Identical media requested concurrently is downloaded once and shared
+        media = getattr(msg, msg_type.lower(), None)
+        key = getattr(media, "file_unique_id", None) or f"{msg.chat.id}_{msg.id}"
+        job_dir = os.path.join(self.rename_folder, f"{message.chat.id}_{message.id}_{suffix}")
+        file = await in_flight.fetch(
+            key,
+            lambda progress_cb: self._download_file(msg, media, f"downloads/{key}/", progress_cb),
+            job_dir,
+            progress=progress,
+            progress_args=(message, f"down{suffix}")
+        )
 
-                # Send to dump
-                dump_msg = await self._send_media_to_dump(file, msg, msg_type, message)
+        progress_bus.close(transfer.key)
+        if task_manager.is_cancelled(message.from_user.id):
+            remove_job_file(file)
+            raise asyncio.CancelledError("Download cancelled after complete.")
+
+        # Rename
+        ext = os.path.splitext(file)[1]
+        new_file = os.path.join(job_dir, f"{filename}{ext}")
+        os.rename(file, new_file)
+        return new_file
+
+    async def _download_file(self, msg: Message, media, download_dir: str, progress_cb) -> str:
+        """Download with the user session, over several connections for large files and
+        in a transfer process when the pool is running"""
+        if not getattr(media, "file_id", None):
+            return await self.acc.download_media(msg, file_name=download_dir, progress=progress_cb)
+        # Both download by file id, which has no name of its own
+        name = getattr(media, "file_name", None) or (
+            media.file_unique_id + (self.acc.guess_extension(getattr(media, "mime_type", None) or "") or "")
+        )
+        if transfer_pool.running:
+            return await transfer_pool.download(self.acc, media, download_dir + name, progress=progress_cb)
+        if ranged_downloader.wants(media.file_size):
+            return await ranged_downloader.download_media(self.acc, media, download_dir + name, msg=msg, progress=progress_cb)
+        return await self.acc.download_media(msg, file_name=download_dir, progress=progress_cb)
+
+    async def _upload_file(self, method: str, chat_id: int, file: str, **kwargs) -> Message:
+        """Send a local file with the bot, in a transfer process when the pool is running"""
+        if transfer_pool.running:
+            return await transfer_pool.upload(self.bot, method, chat_id, file, **kwargs)
+        return await getattr(self.bot, method)(chat_id, file, **kwargs)
+
+    async def _dedup_key(self, message: Message, msg: Message, msg_type: str, user_replacements: dict) -> Optional[str]:
+        """Key the output of this media for the user's current settings"""
+        media = getattr(msg, msg_type.lower(), None)
+        if not self.dedup or not getattr(media, "file_unique_id", None):
+            return None
+
+        settings = await self._user_settings(message.from_user.id)
+        caption, use_filename = settings.get('caption'), settings.get('caption_with_filename', False)
+        thumb_digest = settings.get('thumb_hash')
+        thumb = await self._user_thumbnail(message.from_user.id, msg_type)
+        if thumb and not thumb_digest:
+            # Read off the event loop, and only again once the file changes
+            thumb_digest = await asyncio.get_running_loop().run_in_executor(None, file_refs.digest, thumb)
+
+        return make_key(
+            media.file_unique_id, msg_type, user_replacements,
+            caption, use_filename,
+            None if caption else msg.caption,  # The source caption is reused when no custom one is set
+            thumb_digest
+        )
 
-                # Send to user
-                await self.bot.copy_message(message.chat.id, self.dump_channel_id, dump_msg.id)
-                await cleanup_files(message.id)
+    async def deliver_media(self, message: Message, msg: Message, msg_type: str, prepared: PreparedMedia):
+        """Upload prefetched media to the dump channel and copy it to the user"""
+        dump_msg = await self.upload_media(message, msg, msg_type, prepared)
+        if dump_msg:
+            await self.send_to_user(message, dump_msg)
 
-            except asyncio.CancelledError as ce:
-                task_manager.clear(message.from_user.id)
-                await smsg.edit_text("❌ Task cancelled.")
-                await cleanup_files(message.id)
-                if file and os.path.exists(file): os.remove(file)
-                return
+    async def upload_media(self, message: Message, msg: Message, msg_type: str, prepared: PreparedMedia) -> Optional[Message]:
+        """Upload prefetched media to the dump and destination channels, returning the dump message"""
+        filename, smsg = prepared.filename, prepared.status_msg
+        try:
+            if task_manager.is_cancelled(message.from_user.id):
+                raise asyncio.CancelledError("Upload cancelled.")
+
+            if prepared.dump_msg_id:
+                dump_msg = await self._reuse_cached(message, prepared.dump_msg_id)
+                if dump_msg:
+                    return dump_msg
+                # The cached dump message is gone, transfer the media again
+                await self.dedup.invalidate(prepared.cache_key)
+                prepared.dump_msg_id = None
+                if not self._can_relay(msg, msg_type):
+                    prepared.file = await self._download_media(message, msg, msg_type, filename, prepared.suffix, smsg)
+
+            await smsg.edit_text(f"📤 **Uploading**\n`{filename}`")
+            transfer = progress_bus.open(progress_key(message, f"up{prepared.suffix}"))
+            up_task = asyncio.create_task(upstatus(transfer, smsg, self.bot, filename))
+
+            # Send to dump
+            dump_msg = await self._send_media_to_dump(prepared.file, msg, msg_type, message, filename, prepared.suffix)
+            if prepared.cache_key:
+                media = getattr(msg, msg_type.lower())
+                await self.dedup.put(prepared.cache_key, media.file_unique_id, dump_msg.id)
+            return dump_msg
 
-            except Exception as e:
-                logger.error(f"MediaHandler error: {e}")
-                await self.bot.send_message(message.chat.id, f"**Error**: {e}", reply_to_message_id=message.id)
+        except asyncio.CancelledError:
+            # Only a /cancel is reported here, cancelling the task itself goes up to the caller
+            if not task_manager.is_cancelled(message.from_user.id):
+                raise
+            task_manager.clear(message.from_user.id)
+            await smsg.edit_text("❌ Task cancelled.")
 
-            finally:
-                await cleanup_files(message.id)
-                await self.bot.delete_messages(message.chat.id, [smsg.id])
-                if file and os.path.exists(file): os.remove(file)
+        except Exception as e:
+            logger.error(f"MediaHandler error: {e}")
+            await self.bot.send_message(message.chat.id, f"**Error**: {e}", reply_to_message_id=message.id)
 
-    async def _send_media_to_dump(self, file: str, msg: Message, msg_type: str, message: Message):
-        user_thumb = await get_user_thumbnail(message.from_user.id, self.db)
-        thumb = user_thumb if user_thumb else "thumbnail.jpg"
-        
+        finally:
+            await self.discard_media(message, prepared)
+        return None
+
+    async def upload_album(self, message: Message, msgs: List[Message], msg_types: List[str],
+                           prepared: List[PreparedMedia]) -> Optional[List[Message]]:
+        """Send prefetched album members to the dump channel as one media group, returning its messages"""
+        smsg = prepared[0].status_msg
         try:
-            # Send to dump channel first
-            dump_msg = await self._send_media(self.dump_channel_id, file, msg, msg_type, message, thumb)
-            
-            # Check if user has custom destination
-            dest_channel = await get_destination_channel(message.from_user.id, self.db)
-            if dest_channel:
-                try:
-                    await self.bot.copy_message(
-                        dest_channel,
-                        self.dump_channel_id,
-                        dump_msg.id
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send to destination channel: {e}")
-                    await self.bot.send_message(
-                        message.chat.id,
-                        "⚠️ Failed to send to your destination channel. Please ensure the bot is admin there."
-                    )
-            
-            return dump_msg
+            if task_manager.is_cancelled(message.from_user.id):
+                raise asyncio.CancelledError("Upload cancelled.")
+
+            await smsg.edit_text(f"📤 **Uploading album of {len(msgs)} files**")
+            media = []
+            for msg, msg_type, item in zip(msgs, msg_types, prepared):
+                thumb = await self._user_thumbnail(message.from_user.id, msg_type) or "thumbnail.jpg"
+                caption, entities = await self._caption(message, msg, item.file, item.filename)
+                media.append(await self._input_media(msg, msg_type, item.file, thumb, caption, entities))
+
+            dump_msgs = await self.bot.send_media_group(self.dump_channel_id, media)
+            await self._copy_to_destination(message, dump_msgs[0].id, album=True)
+            return dump_msgs
+
+        except asyncio.CancelledError:
+            # Only a /cancel is reported here, cancelling the task itself goes up to the caller
+            if not task_manager.is_cancelled(message.from_user.id):
+                raise
+            task_manager.clear(message.from_user.id)
+            await smsg.edit_text("❌ Task cancelled.")
+
+        except Exception as e:
+            logger.error(f"MediaHandler error: {e}")
+            await self.bot.send_message(message.chat.id, f"**Error**: {e}", reply_to_message_id=message.id)
 
         finally:
-            for t in ["resized_thumb.jpg"]:
-                if os.path.exists(t): os.remove(t)
+            for item in prepared:
+                await self.discard_media(message, item)
+        return None
 
-    async def _send_media(self, chat_id: int, file: str, msg: Message, msg_type: str, message: Message, thumb: str):
-        # Get user's custom caption
-        caption, use_filename = await get_user_caption(message.from_user.id, self.db)
-        if caption:
-            if use_filename:
-                filename = os.path.splitext(os.path.basename(file))[0]
-                final_caption = caption.replace("{filename}", filename)
+    async def _input_media(self, msg: Message, msg_type: str, file: str, thumb: str, caption: Optional[str], entities):
+        """Album member of the output media group"""
+        caption = caption or ""
+        if msg_type == "Photo":
+            return InputMediaPhoto(file, caption=caption, caption_entities=entities)
+        if msg_type == "Video":
+            duration, width, height = await self._video_meta(msg, file)
+            return InputMediaVideo(
+                file, thumb=thumb, caption=caption, caption_entities=entities,
+                width=width, height=height, duration=duration, supports_streaming=True
+            )
+        if msg_type == "Audio":
+            return InputMediaAudio(
+                file, thumb=thumb, caption=caption, caption_entities=entities,
+                duration=msg.audio.duration, performer=msg.audio.performer, title=msg.audio.title
+            )
+        return InputMediaDocument(file, thumb=thumb, caption=caption, caption_entities=entities)
+
+    async def send_album_to_user(self, message: Message, dump_msgs: List[Message]) -> bool:
+        """Copy an uploaded dump media group into the user's chat, False if that failed"""
+        try:
+            await self.bot.copy_media_group(message.chat.id, self.dump_channel_id, dump_msgs[0].id)
+            return True
+        except Exception as e:
+            logger.error(f"MediaHandler error: {e}")
+            await self.bot.send_message(message.chat.id, f"**Error**: {e}", reply_to_message_id=message.id)
+            return False
+
+    async def send_to_user(self, message: Message, dump_msg: Message) -> bool:
+        """Copy an uploaded dump message into the user's chat, False if that failed"""
+        try:
+            await dump_msg.copy(message.chat.id)
+            return True
+        except Exception as e:
+            logger.error(f"MediaHandler error: {e}")
+            await self.bot.send_message(message.chat.id, f"**Error**: {e}", reply_to_message_id=message.id)
+            return False
+
+    async def _reuse_cached(self, message: Message, dump_msg_id: int) -> Optional[Message]:
+        """Return a cached dump message after copying it to the destination, None if it no longer exists"""
+        dump_msg = await self.bot.get_messages(self.dump_channel_id, dump_msg_id)
+        if not dump_msg or dump_msg.empty:
+            return None
+
+        await self._copy_to_destination(message, dump_msg.id)
+        return dump_msg
+
+    async def discard_media(self, message: Message, prepared: PreparedMedia):
+        """Remove a prefetched file and its status message"""
+        progress_bus.close(progress_key(message, f"down{prepared.suffix}"))
+        progress_bus.close(progress_key(message, f"up{prepared.suffix}"))
+        try:
+            await self.bot.delete_messages(message.chat.id, [prepared.status_msg.id])
+        except Exception as e:
+            logger.error(f"Error deleting status message: {e}")
+        if prepared.file: remove_job_file(prepared.file)
+
+    def _can_relay(self, msg: Message, msg_type: str) -> bool:
+        """Check if media can skip the disk and be relayed chunk by chunk"""
+        if not STREAM_RELAY or msg_type not in ("Document", "Video", "Audio"):
+            return False
+        media = getattr(msg, msg_type.lower(), None)
+        # Unknown sizes can't be announced to the upload and oversized videos must be split on disk
+        return bool(media) and 0 < (media.file_size or 0) <= 2 * 1024 * 1024 * 1024
+
+    async def _send_media_to_dump(self, file: Optional[str], msg: Message, msg_type: str, message: Message, filename: Optional[str] = None, suffix: str = ""):
+        # Prepared when the user set it, nothing is resized here
+        user_thumb = await self._user_thumbnail(message.from_user.id, msg_type)
+        thumb = user_thumb if user_thumb else "thumbnail.jpg"
+
+        # Send to dump channel first
+        dump_msg = await self._send_media(self.dump_channel_id, file, msg, msg_type, message, thumb, filename, suffix)
+
+        # Check if user has custom destination
+        await self._copy_to_destination(message, dump_msg.id)
+        return dump_msg
+
+    async def _copy_to_destination(self, message: Message, dump_msg_id: int, album: bool = False):
+        """Copy a dump message, or the media group it starts, to the user's destination channel, if one is set"""
+        dest_channel = (await self._user_settings(message.from_user.id)).get('destination_channel')
+        if dest_channel:
+            try:
+                copy = self.bot.copy_media_group if album else self.bot.copy_message
+                await copy(
+                    dest_channel,
+                    self.dump_channel_id,
+                    dump_msg_id
+                )
+            except Exception as e:
+                logger.error(f"Failed to send to destination channel: {e}")
+                await self.bot.send_message(
+                    message.chat.id,
+                    "⚠️ Failed to send to your destination channel. Please ensure the bot is admin there."
+                )
+
+    async def _send_media(self, chat_id: int, file: Optional[str], msg: Message, msg_type: str, message: Message, thumb: str, filename: Optional[str] = None, suffix: str = ""):
+        up_type = f"up{suffix}"  # Progress key of this item's upload
+        final_caption, entities = await self._caption(message, msg, file, filename)
+
+        if file is None:
+            return await self._relay_media(chat_id, msg, msg_type, message, thumb, filename, final_caption, entities, up_type)
+
+        if msg_type in ("Document", "Video", "Audio") and not transfer_pool.running:
+            # Sent as uploaded media so the thumbnail upload is reused instead of repeated
+            if os.path.getsize(file) > BIG_FILE_SIZE:
+                # Large files go up part by part over several connections
+                uploaded = await upload_file(self.bot, file, progress=progress, progress_args=(message, up_type))
             else:
-                final_caption = caption
-            # Reset entities when using custom caption
-            entities = None
-        else:
-            final_caption = msg.caption
-            entities = msg.caption_entities
+                uploaded = await self.bot.save_file(file, progress=progress, progress_args=(message, up_type))
+            for attempt in range(3):
+                try:
+                    return await self._send_uploaded(chat_id, msg, msg_type, os.path.basename(file), uploaded, thumb, final_caption, entities, file)
+                except FilePartMissing as e:
+                    if attempt == 2:
+                        raise
+                    # Either file may be the one missing, the thumbnail is cheap to send again
+                    logger.warning(f"Part {e.value} of {file} went missing, uploading it again")
+                    file_refs.forget(thumb)
+                    await upload_missing_part(self.bot, file, uploaded, e.value)
 
         if msg_type == "Document":
-            return await self.bot.send_document(
-                chat_id, file, thumb=thumb, caption=final_caption,
+            return await self._upload_file(
+                "send_document", chat_id, file, thumb=thumb, caption=final_caption,
                 caption_entities=entities, progress=progress,
-                progress_args=[message, "up"]
+                progress_args=[message, up_type]
             )
         elif msg_type == "Video":
-            return await self.bot.send_video(
-                chat_id, file, duration=msg.video.duration,
-                width=320, height=180, thumb=thumb, caption=final_caption,
+            duration, width, height = await self._video_meta(msg, file)
+            return await self._upload_file(
+                "send_video", chat_id, file, duration=duration,
+                width=width, height=height, thumb=thumb, caption=final_caption,
                 caption_entities=entities, progress=progress,
-                progress_args=[message, "up"]
+                progress_args=[message, up_type]
             )
         elif msg_type == "Animation":
-            return await self.bot.send_animation(
-                chat_id, file, thumb=thumb, progress=progress,
-                progress_args=[message, "up"]
+            return await self._upload_file(
+                "send_animation", chat_id, file, thumb=thumb, progress=progress,
+                progress_args=[message, up_type]
             )
         elif msg_type == "Sticker":
-            return await self.bot.send_sticker(chat_id, file)
+            return await self._upload_file("send_sticker", chat_id, file)
         elif msg_type == "Voice":
-            return await self.bot.send_voice(
-                chat_id, file, caption=final_caption,
+            return await self._upload_file(
+                "send_voice", chat_id, file, caption=final_caption,
                 caption_entities=entities, progress=progress,
-                progress_args=[message, "up"]
+                progress_args=[message, up_type]
             )
         elif msg_type == "Audio":
-            return await self.bot.send_audio(
-                chat_id, file, thumb=thumb, caption=final_caption,
+            return await self._upload_file(
+                "send_audio", chat_id, file, thumb=thumb, caption=final_caption,
                 caption_entities=entities, progress=progress,
-                progress_args=[message, "up"]
+                progress_args=[message, up_type]
             )
         elif msg_type == "Photo":
-            return await self.bot.send_photo(
-                chat_id, file, caption=final_caption,
+            return await self._upload_file(
+                "send_photo", chat_id, file, caption=final_caption,
                 caption_entities=entities, progress=progress,
-                progress_args=[message, "up"]
+                progress_args=[message, up_type]
             )
 
-    async def handle_large_video(self, message: Message, msg: Message):
-        """Handle videos larger than 2GB by splitting"""
+    async def _caption(self, message: Message, msg: Message, file: Optional[str], filename: Optional[str]):
+        """Caption and entities of the output, the user's custom caption replacing the source one"""
+        settings = await self._user_settings(message.from_user.id)
+        caption, use_filename = settings.get('caption'), settings.get('caption_with_filename', False)
+        if caption:
+            if use_filename:
+                name = filename if file is None else os.path.splitext(os.path.basename(file))[0]
+                return caption.replace("{filename}", name), None
+            # Reset entities when using custom caption
+            return caption, None
+        return msg.caption, msg.caption_entities
+
+    async def _video_meta(self, msg: Message, file: Optional[str]) -> tuple:
+        """Duration, width and height to announce for a video, probed from the file when there is one"""
+        video = msg.video
+        duration, width, height = video.duration, video.width, video.height
+        if file:
+            try:
+                info = await probe(file)
+                duration = int(info.duration) or duration
+                width, height = info.width or width, info.height or height
+            except Exception as e:
+                logger.warning(f"Could not probe {file}, using the source video's size: {e}")
+        if not (width and height):
+            width, height = DEFAULT_VIDEO_SIZE
+        return duration or 0, width, height
+
+    async def _relay_media(self, chat_id: int, msg: Message, msg_type: str, message: Message, thumb: str, filename: str, caption: Optional[str], entities, up_type: str = "up"):
+        """Stream media from the user session straight into a bot upload"""
+        media = getattr(msg, msg_type.lower())
+        file_name = filename
+        if not os.path.splitext(file_name)[1]:
+            file_name += self.bot.guess_extension(media.mime_type or "") or ""
+
+        uploaded = await upload_stream(
+            self.bot, self.acc.stream_media(msg), media.file_size, file_name,
+            progress=progress, progress_args=(message, up_type)
+        )
+        return await self._send_uploaded(chat_id, msg, msg_type, file_name, uploaded, thumb, caption, entities)
+
+    async def _send_uploaded(self, chat_id: int, msg: Message, msg_type: str, file_name: str, uploaded, thumb: str,
+                             caption: Optional[str], entities, file: Optional[str] = None):
+        """Send an uploaded file as a document, video or audio like the source media"""
+        media = getattr(msg, msg_type.lower())
+        attributes = [raw.types.DocumentAttributeFilename(file_name=file_name)]
+        if msg_type == "Video":
+            duration, width, height = await self._video_meta(msg, file)
+            attributes.insert(0, raw.types.DocumentAttributeVideo(
+                duration=duration, w=width, h=height, supports_streaming=True
+            ))
+        elif msg_type == "Audio":
+            attributes.insert(0, raw.types.DocumentAttributeAudio(
+                duration=media.duration, performer=media.performer, title=media.title
+            ))
+
+        input_media = raw.types.InputMediaUploadedDocument(
+            mime_type=media.mime_type or self.bot.guess_mime_type(file_name) or "application/zip",
+            file=uploaded,
+            thumb=await file_refs.input_file(self.bot, thumb),
+            attributes=attributes
+        )
+        return await send_uploaded_media(self.bot, chat_id, input_media, caption, entities)
+
+    async def handle_large_video(self, message: Message, msg: Message) -> bool:
+        """Handle videos larger than 2GB by splitting, uploading each part while the next one is cut.
+
+        Returns whether every part was sent.
+        """
         status_msg = await self.bot.send_message(
             message.chat.id,
             "📥 **Processing large video...\nDownloading and splitting into parts...**",
             reply_to_message_id=message.id
         )
         
+        file_path = None
         try:
             # Download video
-            file_path = await msg.download()
-            
-            # Split video
-            split_files = await split_video(file_path)
+            file_path = await self._download_file(msg, msg.video, f"downloads/{msg.video.file_unique_id}/", None)
+            thumb = await self._user_thumbnail(message.from_user.id, "Video") or "thumbnail.jpg"
             
-            # Upload parts
-            for i, part_path in enumerate(split_files, 1):
-                caption = f"**{msg.caption or msg.video.file_name}**\n"
-                caption += f"Part {i} of {len(split_files)}\n"
-                if i == 1:
-                    caption += "\n**Note:** Use any video joiner to combine parts after download."
-                
-                await self.bot.send_video(
-                    message.chat.id,
-                    video=part_path,
-                    caption=caption,
-                    thumb=msg.video.thumbs[0].file_id if msg.video.thumbs else None,
-                    progress=self.progress_callback,
-                    progress_args=(status_msg,)
-                )
+            # Upload parts as the splitter finishes them, closing it on the way out so it stops cutting
+            async with aclosing(iter_split_video(file_path)) as split_parts:
+                async for i, parts, part_path in split_parts:
+                    try:
+                        caption = f"**{msg.caption or msg.video.file_name}**\n"
+                        caption += f"Part {i} of {parts}\n"
+                        if i == 1:
+                            caption += "\n**Note:** Use any video joiner to combine parts after download."
+                    
+                        duration, width, height = await self._video_meta(msg, part_path)
+                        up_type = f"up{msg.id}_{i}"
+                        transfer = progress_bus.open(progress_key(message, up_type))
+                        up_task = asyncio.create_task(upstatus(transfer, status_msg, self.bot, f"Part {i} of {parts}"))
+                        try:
+                            await self._upload_file(
+                                "send_video", message.chat.id, part_path,
+                                caption=caption,
+                                duration=duration,
+                                width=width,
+                                height=height,
+                                thumb=thumb,
+                                supports_streaming=True,
+                                progress=progress,
+                                progress_args=(message, up_type)
+                            )
+                        finally:
+                            progress_bus.close(transfer.key)
+                            await up_task
+                    finally:
+                        # Only this part and the one being cut are on disk at a time
+                        if part_path != file_path:
+                            await cleanup_split_files([part_path])
                 
             await status_msg.edit_text("✅ **Video parts uploaded successfully!**")
+            return True
             
+        except asyncio.CancelledError:
+            # A cancel from the user is reported like a failure, only cancelling the task goes up
+            by_user = task_manager.is_cancelled(message.from_user.id)
+            task_manager.clear(message.from_user.id)
+            await status_msg.edit_text("❌ Task cancelled.")
+            if not by_user:
+                raise
+
         except Exception as e:
             logger.error(f"Error handling large video: {e}")
             await status_msg.edit_text(f"❌ **Error processing video: {str(e)}**")
             
         finally:
             # Cleanup
-            if 'file_path' in locals():
-                try:
-                    os.remove(file_path)
-                except:
-                    pass
-            if 'split_files' in locals():
-                await cleanup_split_files(split_files)
+            if file_path:
+                remove_job_file(file_path)
+        return False
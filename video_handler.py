@@ -1,77 +1,229 @@
 import os
-import math
+import json
 import asyncio
 import logging
-from pathlib import Path
-from typing import List, Tuple
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional, Tuple
 import ffmpeg
 
 logger = logging.getLogger(__name__)
 
+SPLIT_MARGIN = 0.02  # Share of target_size left for container overhead and interleaving slack
+PROBE_CACHE_SIZE = 256  # Files whose metadata is kept
+
+class VideoInfo:
+    """Metadata of a media file from one ffprobe -show_format -show_streams call"""
+    def __init__(self, path: str, info: dict):
+        fmt = info.get('format', {})
+        self.path = path
+        self.streams: List[dict] = info.get('streams', [])
+        self.duration = _number(fmt.get('duration')) or 0.0
+        self.bit_rate = int(_number(fmt.get('bit_rate')) or 0) or None  # ffprobe reports N/A for some containers
+
+        video = self._first("video")
+        audio = self._first("audio")
+        self.video_index = video['index'] if video else None
+        self.audio_index = audio['index'] if audio else None
+        self.video_codec = video.get('codec_name') if video else None
+        self.audio_codec = audio.get('codec_name') if audio else None
+        self.width = int(video.get('width') or 0) if video else 0
+        self.height = int(video.get('height') or 0) if video else 0
+        if video and abs(_rotation(video)) in (90, 270):
+            # Players show rotated videos on their side, so should the announced size
+            self.width, self.height = self.height, self.width
+        self.keyframes: Optional[List[float]] = None  # Video keyframe times, filled when asked for
+
+    def _first(self, codec_type: str) -> Optional[dict]:
+        return next((s for s in self.streams if s.get('codec_type') == codec_type), None)
+
+def _number(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _rotation(stream: dict) -> int:
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            return int(_number(side_data['rotation']) or 0)
+    return int(_number(stream.get('tags', {}).get('rotate')) or 0)
+
+_probe_cache: "OrderedDict[tuple, VideoInfo]" = OrderedDict()
+
+async def probe(path: str, keyframes: bool = False) -> VideoInfo:
+    """Metadata of a file, probed once per path, mtime and size"""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    info = _probe_cache.get(key)
+    if info is None:
+        info = VideoInfo(path, await _run_json(
+            'ffprobe', '-v', 'error', '-show_format', '-show_streams', '-of', 'json', path
+        ))
+        _probe_cache[key] = info
+        while len(_probe_cache) > PROBE_CACHE_SIZE:
+            _probe_cache.popitem(last=False)
+    _probe_cache.move_to_end(key)
+
+    if keyframes and info.keyframes is None and info.video_index is not None:
+        info.keyframes = [
+            time async for _, time, _, keyframe in _packets(path, info.video_index)
+            if keyframe and time is not None
+        ]
+    return info
+
 async def get_video_duration(file_path: str) -> float:
     """Get video duration in seconds using ffprobe"""
     try:
-        probe = await asyncio.create_subprocess_exec(
-            'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-            '-of', 'default=noprint_wrappers=1:nokey=1', file_path,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await probe.communicate()
-        return float(stdout.decode().strip())
+        return (await probe(file_path)).duration
     except Exception as e:
         logger.error(f"Error getting video duration: {e}")
         return 0
 
-async def split_video(input_path: str, target_size: int = 1.95*1024*1024*1024) -> List[str]:
-    """Split video into parts smaller than target_size (default 1.95GB)"""
-    duration = await get_video_duration(input_path)
-    if duration == 0:
-        raise ValueError("Could not determine video duration")
-
-    # Get video bitrate
-    probe = await asyncio.create_subprocess_exec(
-        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
-        '-show_entries', 'stream=bit_rate', '-of', 'default=noprint_wrappers=1:nokey=1',
-        input_path,
+class SplitPlan:
+    """Where a video will be cut, decided from its packets before anything is written"""
+    def __init__(self, input_path: str, duration: float, streams: List[int], cuts: List[float], part_sizes: List[int]):
+        self.input_path = input_path
+        self.duration = duration
+        self.streams = streams  # Indexes of the input streams the parts keep
+        self.cuts = cuts  # Keyframe times starting every part after the first
+        self.part_sizes = part_sizes  # Estimated bytes of each part
+
+    @property
+    def parts(self) -> int:
+        return len(self.cuts) + 1
+
+    def ranges(self) -> List[Tuple[float, Optional[float]]]:
+        """(start, end) of every part in seconds, the last one open ended"""
+        starts = [0.0] + self.cuts
+        return list(zip(starts, self.cuts + [None]))
+
+async def _run_json(*cmd: str) -> dict:
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE
     )
-    stdout, stderr = await probe.communicate()
-    bit_rate = int(stdout.decode().strip())
-
-    # Calculate number of parts needed
-    file_size = os.path.getsize(input_path)
-    num_parts = math.ceil(file_size / target_size)
-    segment_duration = duration / num_parts
-    
-    output_files = []
-    input_filename = Path(input_path).stem
-
-    for i in range(num_parts):
-        start_time = i * segment_duration
-        output_path = f"{input_path}_{i+1}.mp4"
-        
-        cmd = [
-            'ffmpeg', '-i', input_path,
-            '-ss', str(start_time),
-            '-t', str(segment_duration),
-            '-c', 'copy',
-            '-y',
-            output_path
-        ]
-        
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        await process.communicate()
-        if os.path.exists(output_path):
-            output_files.append(output_path)
-            
-    return output_files
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise ValueError(f"{cmd[0]} failed: {stderr.decode(errors='replace').strip()}")
+    return json.loads(stdout or b"{}")
+
+async def _packets(input_path: str, stream: Optional[int] = None) -> AsyncIterator[Tuple[int, float, int, bool]]:
+    """(stream index, time, size, keyframe) of every packet in demux order, of one stream if given"""
+    select = ['-select_streams', str(stream)] if stream is not None else []
+    process = await asyncio.create_subprocess_exec(
+        'ffprobe', '-v', 'error', *select, '-show_entries', 'packet=stream_index,pts_time,dts_time,size,flags',
+        '-of', 'compact=p=0', input_path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        async for line in process.stdout:
+            fields = dict(field.split('=', 1) for field in line.decode().strip().split('|') if '=' in field)
+            if 'size' not in fields:
+                continue
+            time_str = fields.get('pts_time', 'N/A')
+            if time_str == 'N/A':
+                time_str = fields.get('dts_time', 'N/A')
+            time = float(time_str) if time_str != 'N/A' else None
+            yield int(fields['stream_index']), time, int(fields['size']), 'K' in fields.get('flags', '')
+    finally:
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+
+async def plan_cuts(packets: AsyncIterator, video_index: int, kept: List[int], budget: int) -> Tuple[List[float], List[int]]:
+    """Greedily cut at the last video keyframe before a part would outgrow `budget` bytes"""
+    cuts, part_sizes = [], []
+    part_bytes = 0
+    last_key = None  # (time, bytes of the part before that keyframe)
+    async for index, time, size, keyframe in packets:
+        if index not in kept:
+            continue
+        if index == video_index and keyframe and time is not None and time > (cuts[-1] if cuts else 0):
+            last_key = (time, part_bytes)
+        part_bytes += size
+        if part_bytes > budget:
+            if last_key is None or last_key[1] == 0:
+                raise ValueError(f"No keyframe lets a part stay under {budget} bytes")
+            cuts.append(last_key[0])
+            part_sizes.append(last_key[1])
+            part_bytes -= last_key[1]
+            last_key = None
+    part_sizes.append(part_bytes)
+    return cuts, part_sizes
+
+async def plan_split(input_path: str, target_size: int = 1.95*1024*1024*1024, margin: float = SPLIT_MARGIN) -> SplitPlan:
+    """Plan parts of a video that each stay under target_size, cut on video keyframes"""
+    info = await probe(input_path)
+    if info.video_index is None:
+        raise ValueError("No video stream to split on")
+    # The parts keep the first video and the first audio stream
+    kept = [index for index in (info.video_index, info.audio_index) if index is not None]
+
+    # Parts are sized from the bytes of the packets they will hold
+    budget = int(target_size * (1 - margin))
+    cuts, part_sizes = await plan_cuts(_packets(input_path), info.video_index, kept, budget)
+    plan = SplitPlan(input_path, info.duration, kept, cuts, part_sizes)
+    logger.info(f"Planned {plan.parts} parts of {input_path}: cuts at {', '.join(f'{c:.2f}s' for c in cuts) or 'none'}")
+    return plan
+
+async def _cut_part(plan: SplitPlan, index: int) -> str:
+    """Copy one planned part out of the input, seeking to its keyframe instead of decoding up to it"""
+    start, end = plan.ranges()[index]
+    output_path = f"{plan.input_path}_{index + 1}.mp4"
+    # Just past the keyframe, so rounding of its time can't make the seek land on the previous one
+    cmd = ['ffmpeg', '-v', 'error', '-ss', f"{start + 0.0005:.6f}" if start else "0", '-i', plan.input_path]
+    if end is not None:
+        cmd += ['-t', f"{end - start:.6f}"]
+    cmd += [
+        *[arg for stream in plan.streams for arg in ('-map', f'0:{stream}')],
+        '-c', 'copy',
+        '-avoid_negative_ts', 'make_zero',
+        '-y',
+        output_path
+    ]
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await process.communicate()
+    except BaseException:
+        process.kill()
+        await process.wait()
+        await cleanup_split_files([output_path])
+        raise
+    if process.returncode != 0:
+        await cleanup_split_files([output_path])
+        raise ValueError(f"ffmpeg failed on part {index + 1}: {stderr.decode(errors='replace').strip()}")
+    return output_path
+
+async def iter_split_video(input_path: str, target_size: int = 1.95*1024*1024*1024) -> AsyncIterator[Tuple[int, int, str]]:
+    """Yield (part, parts, path) as soon as each part is cut, cutting at most one part ahead.
+
+    The caller owns a yielded file and should delete it once done, so only about two parts
+    are on disk at a time. A video small enough already is yielded as `input_path` itself,
+    which is not the caller's to delete as a part.
+    """
+    plan = await plan_split(input_path, target_size)
+    if not plan.cuts:
+        yield 1, 1, input_path
+        return
+
+    ahead = asyncio.create_task(_cut_part(plan, 0))
+    try:
+        for index in range(plan.parts):
+            path = await ahead
+            ahead = asyncio.create_task(_cut_part(plan, index + 1)) if index + 1 < plan.parts else None
+            yield index + 1, plan.parts, path
+    finally:
+        if ahead:
+            ahead.cancel()
+            await asyncio.gather(ahead, return_exceptions=True)
+            if ahead.done() and not ahead.cancelled() and not ahead.exception():
+                await cleanup_split_files([ahead.result()])
 
 async def cleanup_split_files(file_paths: List[str]):
     """Clean up split video files"""
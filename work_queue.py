@@ -0,0 +1,347 @@
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Union
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import WORKER_ID
+except ImportError:
+    WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+try:
+    from config import WORKER_CONCURRENCY
+except ImportError:
+    WORKER_CONCURRENCY = 3  # Items one node processes at the same time
+
+try:
+    from config import LEASE_SECONDS
+except ImportError:
+    LEASE_SECONDS = 120  # A claim not renewed for this long is handed to another node
+
+MAX_ATTEMPTS = 3  # Items claimed this many times without completing are given up on
+POLL_INTERVAL = 2  # Seconds an idle worker waits before looking for work again
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# Messages an item stands for, an album counts each of its members like run_job does
+MESSAGE_COUNT = {'$cond': [{'$isArray': '$item_id'}, {'$size': '$item_id'}, 1]}
+
+def _new_item(job_id, item_id: Union[int, Sequence[int]]) -> dict:
+    return {
+        'job_id': job_id,
+        'item_id': item_id,
+        'status': QUEUED,
+        'owner': None,
+        'lease_expires_at': None,
+        'attempts': 0,
+        'created_at': _now()
+    }
+
+class MongoWorkQueue:
+    """Work items shared by every node through MongoDB, claimed with expiring leases"""
+
+    def __init__(self, db):
+        self.collection = db.work_items
+
+    async def setup(self):
+        await self.collection.create_index([('status', 1), ('created_at', 1), ('item_id', 1)])
+        await self.collection.create_index('job_id')
+
+    async def enqueue(self, job_id, item_ids: Iterable[Union[int, Sequence[int]]]):
+        """Queue the items of a job, an album goes in as the ids of its members"""
+        items = [_new_item(job_id, item_id) for item_id in item_ids]
+        if items:
+            await self.collection.insert_many(items)
+
+    async def claim(self, worker_id: str, lease_seconds: float) -> Optional[dict]:
+        """Lease the oldest waiting item, or one whose owner stopped renewing its lease"""
+        now = _now()
+        before = await self.collection.find_one_and_update(
+            {'$or': [
+                {'status': QUEUED},
+                {'status': LEASED, 'lease_expires_at': {'$lt': now}}
+            ]},
+            {
+                '$set': {
+                    'status': LEASED,
+                    'owner': worker_id,
+                    'lease_expires_at': now + timedelta(seconds=lease_seconds)
+                },
+                # Counted on claim, so an item that keeps killing its node runs out of attempts too
+                '$inc': {'attempts': 1}
+            },
+            sort=[('created_at', 1), ('item_id', 1)],
+            return_document=ReturnDocument.BEFORE
+        )
+        if before is None:
+            return None
+        if before['status'] == LEASED:
+            logger.warning(f"Reclaimed item {before['item_id']} from expired lease of {before['owner']}")
+        return dict(before, status=LEASED, owner=worker_id, attempts=before.get('attempts', 0) + 1)
+
+    async def heartbeat(self, item: dict, worker_id: str, lease_seconds: float) -> bool:
+        """Extend a lease, False once it has been lost to another node"""
+        result = await self.collection.update_one(
+            {'_id': item['_id'], 'owner': worker_id, 'status': LEASED},
+            {'$set': {'lease_expires_at': _now() + timedelta(seconds=lease_seconds)}}
+        )
+        return result.matched_count == 1
+
+    async def complete(self, item: dict, worker_id: str):
+        await self.collection.update_one(
+            {'_id': item['_id'], 'owner': worker_id, 'status': LEASED},
+            {'$set': {'status': DONE, 'lease_expires_at': None}}
+        )
+
+    async def release(self, item: dict, worker_id: str, error: str, failed: bool = True):
+        """Hand an item back, giving up after MAX_ATTEMPTS failures.
+
+        `failed=False` gives back the attempt of its claim, for items dropped by a stopping node.
+        """
+        update = {'$set': {
+            'status': FAILED if failed and item.get('attempts', 0) >= MAX_ATTEMPTS else QUEUED,
+            'owner': None,
+            'lease_expires_at': None,
+            'error': error
+        }}
+        if not failed:
+            update['$inc'] = {'attempts': -1}
+        await self.collection.update_one({'_id': item['_id'], 'owner': worker_id, 'status': LEASED}, update)
+
+    async def cancel(self, job_id):
+        """Drop the items of a job nobody has claimed yet"""
+        await self.collection.update_many(
+            {'job_id': job_id, 'status': QUEUED},
+            {'$set': {'status': CANCELLED}}
+        )
+
+    async def forget(self, job_id):
+        """Drop the items of a closed job"""
+        await self.collection.delete_many({'job_id': job_id})
+
+    async def job_counts(self, job_id) -> Dict[str, int]:
+        counts = {}
+        async for row in self.collection.aggregate([
+            {'$match': {'job_id': job_id}},
+            {'$group': {'_id': '$status', 'count': {'$sum': MESSAGE_COUNT}}}
+        ]):
+            counts[row['_id']] = row['count']
+        return counts
+
+    async def stats(self) -> Dict[str, int]:
+        counts = {}
+        async for row in self.collection.aggregate([
+            {'$match': {'status': {'$in': [QUEUED, LEASED]}}},
+            {'$group': {'_id': '$status', 'count': {'$sum': MESSAGE_COUNT}}}
+        ]):
+            counts[row['_id']] = row['count']
+        return {'queued': counts.get(QUEUED, 0), 'leased': counts.get(LEASED, 0)}
+
+class LocalWorkQueue:
+    """In-memory stand-in for MongoWorkQueue, for running frontend and workers in one process"""
+
+    def __init__(self):
+        self._items: List[dict] = []
+        self._next_id = 0
+
+    async def setup(self):
+        pass
+
+    async def enqueue(self, job_id, item_ids: Iterable[Union[int, Sequence[int]]]):
+        for item_id in item_ids:
+            self._next_id += 1
+            self._items.append(dict(_new_item(job_id, item_id), _id=self._next_id))
+
+    async def claim(self, worker_id: str, lease_seconds: float) -> Optional[dict]:
+        now = _now()
+        for item in self._items:
+            expired = item['status'] == LEASED and item['lease_expires_at'] < now
+            if item['status'] == QUEUED or expired:
+                if expired:
+                    logger.warning(f"Reclaimed item {item['item_id']} from expired lease of {item['owner']}")
+                item.update(status=LEASED, owner=worker_id, lease_expires_at=now + timedelta(seconds=lease_seconds))
+                item['attempts'] += 1
+                return dict(item)
+        return None
+
+    def _owned(self, item: dict, worker_id: str) -> Optional[dict]:
+        for stored in self._items:
+            if stored['_id'] == item['_id']:
+                return stored if stored['owner'] == worker_id and stored['status'] == LEASED else None
+        return None
+
+    async def heartbeat(self, item: dict, worker_id: str, lease_seconds: float) -> bool:
+        stored = self._owned(item, worker_id)
+        if stored:
+            stored['lease_expires_at'] = _now() + timedelta(seconds=lease_seconds)
+        return stored is not None
+
+    async def complete(self, item: dict, worker_id: str):
+        stored = self._owned(item, worker_id)
+        if stored:
+            # Finished items are only needed for the counts of a running job
+            stored.update(status=DONE, lease_expires_at=None)
+
+    async def release(self, item: dict, worker_id: str, error: str, failed: bool = True):
+        stored = self._owned(item, worker_id)
+        if stored:
+            if not failed:
+                stored['attempts'] -= 1
+            stored.update(
+                status=FAILED if failed and stored['attempts'] >= MAX_ATTEMPTS else QUEUED,
+                owner=None, lease_expires_at=None, error=error
+            )
+
+    async def cancel(self, job_id):
+        for item in self._items:
+            if item['job_id'] == job_id and item['status'] == QUEUED:
+                item['status'] = CANCELLED
+
+    async def forget(self, job_id):
+        self._items = [item for item in self._items if item['job_id'] != job_id]
+
+    async def job_counts(self, job_id) -> Dict[str, int]:
+        counts = {}
+        for item in self._items:
+            if item['job_id'] == job_id:
+                counts[item['status']] = counts.get(item['status'], 0) + _messages(item)
+        return counts
+
+    async def stats(self) -> Dict[str, int]:
+        return {
+            'queued': sum(_messages(item) for item in self._items if item['status'] == QUEUED),
+            'leased': sum(_messages(item) for item in self._items if item['status'] == LEASED)
+        }
+
+class LeaseWorker:
+    """Claims items from a work queue and keeps their leases alive while `handle` runs"""
+
+    def __init__(
+        self,
+        queue,
+        handle: Callable[[dict], Awaitable[None]],
+        after: Optional[Callable[[dict], Awaitable[None]]] = None,
+        worker_id: str = WORKER_ID,
+        concurrency: int = WORKER_CONCURRENCY,
+        lease_seconds: float = LEASE_SECONDS
+    ):
+        self.queue = queue
+        self.handle = handle
+        self.after = after  # Called once an item is completed or released
+        self.worker_id = worker_id
+        self.concurrency = max(1, concurrency)
+        self.lease_seconds = lease_seconds
+        self.running = 0
+        self.completed = 0
+        self.released = 0
+        self.lost = 0
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        logger.info(f"Worker {self.worker_id} taking up to {self.concurrency} items")
+        self._tasks = [asyncio.create_task(self._loop()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _loop(self):
+        while True:
+            try:
+                item = await self.queue.claim(self.worker_id, self.lease_seconds)
+            except Exception as e:
+                logger.error(f"Error claiming work: {e}")
+                item = None
+            if item is None:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            await self._run(item)
+
+    async def _run(self, item: dict):
+        if item.get('attempts', 0) > MAX_ATTEMPTS:
+            # Every node that took it lost its lease, most likely by dying on it
+            logger.error(f"Giving up on item {item['item_id']} of job {item['job_id']} after {MAX_ATTEMPTS} attempts")
+            await self.queue.release(item, self.worker_id, "lease expired on every attempt")
+            self.released += 1
+        elif not await self._handle(item):
+            return
+
+        if self.after:
+            try:
+                await self.after(item)
+            except Exception as e:
+                logger.error(f"Error finishing item {item['item_id']}: {e}")
+
+    async def _handle(self, item: dict) -> bool:
+        """Run `handle` on a claimed item, False if another node took it over meanwhile"""
+        lost = asyncio.Event()
+        task = asyncio.create_task(self.handle(item))
+        beat = asyncio.create_task(self._heartbeat(item, task, lost))
+        self.running += 1
+        try:
+            await task
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                # This node is stopping, let another one take the item right away without charging it
+                task.cancel()
+                await self.queue.release(item, self.worker_id, "worker stopped", failed=False)
+                raise
+            if lost.is_set():
+                self.lost += 1
+                logger.warning(f"Lost lease on item {item['item_id']}, another node took it over")
+                return False
+            # Only the handler was cancelled, the worker goes on with its next item
+            logger.error(f"Processing item {item['item_id']} of job {item['job_id']} was cancelled")
+            await self.queue.release(item, self.worker_id, "cancelled")
+            self.released += 1
+        except Exception as e:
+            logger.error(f"Error processing item {item['item_id']} of job {item['job_id']}: {e}")
+            await self.queue.release(item, self.worker_id, str(e))
+            self.released += 1
+        else:
+            await self.queue.complete(item, self.worker_id)
+            self.completed += 1
+        finally:
+            self.running -= 1
+            beat.cancel()
+        return True
+
+    async def _heartbeat(self, item: dict, task: asyncio.Task, lost: asyncio.Event):
+        while not task.done():
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                alive = await self.queue.heartbeat(item, self.worker_id, self.lease_seconds)
+            except Exception as e:
+                # Keep going, the lease still has time left for the next beat
+                logger.error(f"Error renewing lease on item {item['item_id']}: {e}")
+                continue
+            if not alive:
+                lost.set()
+                task.cancel()
+                return
+
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'completed': self.completed,
+            'released': self.released,
+            'lost': self.lost
+        }
+
+def _messages(item: dict) -> int:
+    return len(item['item_id']) if isinstance(item['item_id'], (list, tuple)) else 1
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)